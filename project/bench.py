@@ -0,0 +1,424 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+# Route-level load test.
+#
+#   python bench.py                      # seed, start gunicorn, run, save JSON
+#   python bench.py --compare old.json   # ...and print the change per route
+#
+# A fresh SQLite database is seeded with --users/--notes/--students/...
+# rows, gunicorn is started on it with gunicorn.conf.py, and every scenario
+# below is run for --duration seconds by --clients concurrent clients, each
+# logged in as its own user over a keep-alive connection. Uploads and games
+# go to a temporary folder, never into website/static.
+#
+# Results (requests/s, p50/p95/p99 latency, status counts per scenario) are
+# printed and written to --output (a bench-<time>.json in the system temp
+# folder unless given), so runs can be compared later.
+
+PASSWORD = 'benchpass1'
+SUBJECTS = ['Math', 'Science', 'History', 'English', 'ICT', 'Dzongkha']
+SECTIONS = ['6A', '6B', '7A', '7B', '8A', '8B']
+SEARCH_SCOPES = ('all', 'mine', 'shared')
+WORDS = ('photosynthesis mitochondria algebra fraction river kingdom grammar poem '
+         'electricity magnet volcano climate equation history monastery circuit').split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Route-level load test for the website.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--notes', type=int, default=5000)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--teachers', type=int, default=500)
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--scores', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients per scenario')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='gunicorn threads per worker for ordinary requests '
+                             '(gunicorn.conf.py adds the live leaderboard stream threads)')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--scenarios', help='comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--output', default=os.path.join(
+        tempfile.gettempdir(), f"bench-{datetime.now():%Y%m%d-%H%M%S}.json"))
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+# ---------------- SEEDING -----------------
+
+def seed(args, workdir):
+    # Seed through the app's own models; Core inserts keep large volumes fast
+    # (the search index triggers still fire for every note)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from website import create_app, db
+    from website.leaderboard import rebuild_leaderboard
+    from website.models import FlappyScore, FlappyStats, Game, Note, Student, Teacher, User
+    from website.ordering import GAP
+    from website.passwords import password_hasher
+
+    rng = random.Random(args.seed)
+    app = create_app()
+    app.config['PASSWORD_HASH_SYNC'] = True
+    now = datetime.utcnow()
+
+    def insert(model, rows):
+        for start in range(0, len(rows), 5000):
+            db.session.execute(db.insert(model), rows[start:start + 5000])
+
+    def text(count):
+        return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+    with app.app_context():
+        # One real hash (at the configured cost) shared by every bench user
+        password = password_hasher.hash(PASSWORD)
+        insert(User, [{'id': i + 1, 'email': f'bench{i}@example.com', 'first_name': f'Bench{i}',
+                       'password': password} for i in range(args.users)])
+        insert(Note, [{'data': text(20), 'subject': rng.choice(SUBJECTS), 'user_id': rng.randint(1, args.users),
+                       'public': rng.random() < 0.3, 'date': now - timedelta(minutes=i)}
+                      for i in range(args.notes)])
+        for model, count, field, values in ((Student, args.students, 'class_section', SECTIONS),
+                                            (Teacher, args.teachers, 'subject', SUBJECTS)):
+            insert(model, [{'name': f'{rng.choice(WORDS).title()} {i}', 'age': rng.randint(10, 60),
+                            'contact': f'17{i:06d}', field: rng.choice(values), 'user_id': i % args.users + 1,
+                            'position': (i // args.users + 1) * GAP} for i in range(count)])
+        insert(Game, [{'title': f'Game {i}', 'description': text(10), 'filename': f'game{i}.html',
+                       'file_type': 'web', 'entry_point': f'game{i}.html', 'total_size': 100,
+                       'user_id': i % args.users + 1, 'downloads': 0} for i in range(args.games)])
+        insert(FlappyScore, [{'player_name': f'Bench{u}', 'score': rng.randint(0, 200), 'user_id': u + 1,
+                              'date_achieved': now - timedelta(seconds=i)}
+                             for i in range(args.scores) for u in [rng.randrange(args.users)]])
+        db.session.commit()
+
+        # The summary tables were created empty at startup; rebuild from the scores
+        FlappyStats.query.delete()
+        rebuild_leaderboard()
+        db.session.commit()
+
+    games_folder = os.path.join(workdir, 'games')
+    for i in range(args.games):
+        with open(os.path.join(games_folder, f'game{i}.html'), 'w') as f:
+            f.write(f'<html><body>Game {i}</body></html>')
+
+
+# ---------------- CLIENT -----------------
+
+class Client:
+    # One keep-alive connection with its own cookies (so its own session)
+
+    def __init__(self, port):
+        self.port = port
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection; reconnect once
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        for header, value in response.getheaders():
+            if header.lower() == 'set-cookie':
+                name, _, rest = value.partition('=')
+                self.cookies[name] = rest.split(';', 1)[0]
+        return response.status, data
+
+    def form(self, path, fields):
+        return self.request('POST', path, urlencode(fields),
+                            {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def json(self, path, payload):
+        return self.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+
+    def multipart(self, path, fields, files):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        for name, (filename, content) in files.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                         f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        return self.request('POST', path, b''.join(parts),
+                            {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+    def login(self, user):
+        status, _ = self.form('/login', {'email': f'bench{user}@example.com', 'password': PASSWORD})
+        if status != 302 or 'session' not in self.cookies:
+            raise RuntimeError(f'login as bench{user} failed with status {status}')
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+# ---------------- SCENARIOS -----------------
+# Each takes (client, user, rng) and makes exactly one request.
+
+def login(client, user, rng):
+    client.cookies.clear()
+    return client.form('/login', {'email': f'bench{user}@example.com', 'password': PASSWORD})
+
+
+def home(client, user, rng):
+    return client.request('GET', '/')
+
+
+def notes(client, user, rng):
+    return client.request('GET', '/notes')
+
+
+def notes_api(client, user, rng):
+    return client.request('GET', '/api/notes')
+
+
+def search(client, user, rng):
+    return client.request('GET', f'/search?q={rng.choice(WORDS)[:5]}&scope={rng.choice(SEARCH_SCOPES)}')
+
+
+def students(client, user, rng):
+    return client.request('GET', '/stdu')
+
+
+def students_filtered(client, user, rng):
+    return client.request('GET', f'/stdu?class_section={rng.choice(SECTIONS)}')
+
+
+def teachers(client, user, rng):
+    return client.request('GET', '/teacher')
+
+
+def reorder(client, user, rng):
+    # Drag one of this user's students to a random place in their list
+    # (the move is timed together with the page that lists the students)
+    status, data = client.request('GET', '/api/students')
+    ids = [row['id'] for row in json.loads(data)['items'] if row['owned']] if status == 200 else []
+    if not ids:
+        return status, data
+    return client.json('/reorder-students', {'move': {'id': rng.choice(ids), 'index': rng.randrange(50)}})
+
+
+def upload(client, user, rng):
+    content = f'{rng.random()} '.encode() * rng.randint(100, 2000)
+    return client.multipart('/', {'note': 'bench upload', 'subject': rng.choice(SUBJECTS)},
+                            {'file': ('bench.txt', content)})
+
+
+def games(client, user, rng):
+    return client.request('GET', '/games')
+
+
+def leaderboard(client, user, rng):
+    return client.request('GET', '/flappy-leaderboard')
+
+
+def score(client, user, rng):
+    return client.json('/submit-flappy-score', {'score': rng.randint(0, 250)})
+
+
+SCENARIOS = {fn.__name__: fn for fn in (
+    login, home, notes, notes_api, search, students, students_filtered, teachers,
+    reorder, upload, games, leaderboard, score,
+)}
+
+
+# ---------------- RUNNING -----------------
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, args):
+    scenario = SCENARIOS[name]
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    deadline = [None]
+    # The clock starts once every client has logged in
+    ready = threading.Barrier(args.clients + 1,
+                              action=lambda: deadline.__setitem__(0, time.perf_counter() + args.duration))
+
+    def worker(index):
+        rng = random.Random(f'{args.seed}-{name}-{index}')
+        user = index % args.users
+        client = Client(args.port)
+        try:
+            if name != 'login':
+                client.login(user)
+        except Exception as e:
+            errors.append(str(e))
+        ready.wait()
+        local, local_statuses = [], {}
+        while time.perf_counter() < deadline[0]:
+            start = time.perf_counter()
+            try:
+                status, _ = scenario(client, user, rng)
+            except Exception as e:
+                status = type(e).__name__
+                client.close()
+                client.conn = None
+            local.append(time.perf_counter() - start)
+            local_statuses[str(status)] = local_statuses.get(str(status), 0) + 1
+        client.close()
+        with lock:
+            latencies.extend(local)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status.isdigit() and int(status) < 400)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'ok': ok,
+        'statuses': statuses,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'setup_errors': errors[:5],
+    }
+
+
+def start_server(args, env):
+    # Workers and threads go through the environment, as in production, so
+    # gunicorn.conf.py still adds its stream threads on top
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(env, WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'main:app',
+         '--bind', f'127.0.0.1:{args.port}', '--access-logfile', '/dev/null'],
+        cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    for _ in range(100):
+        try:
+            status, _ = Client(args.port).request('GET', '/login')
+            if status == 200:
+                return server
+        except OSError:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited:\n' + server.stderr.read())
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start within 10 seconds')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    print(f"\n{'scenario':<18}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ok':>8}{'reqs':>8}"
+          + ('   vs previous (req/s, p95)' if previous else ''))
+    for name, result in results.items():
+        line = (f"{name:<18}{result['throughput']:>9}{result['p50_ms'] or '-':>9}{result['p95_ms'] or '-':>9}"
+                f"{result['p99_ms'] or '-':>9}{result['ok']:>8}{result['requests']:>8}")
+        old = (previous or {}).get(name)
+        if old and old['throughput'] and old['p95_ms'] and result['p95_ms']:
+            line += (f"   {(result['throughput'] / old['throughput'] - 1) * 100:+6.1f}%"
+                     f" {(result['p95_ms'] / old['p95_ms'] - 1) * 100:+6.1f}%")
+        print(line)
+
+
+def main():
+    args = parse_args()
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f'unknown scenarios: {", ".join(unknown)}')
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               GAMES_FOLDER=os.path.join(workdir, 'games'),
+               LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'))
+    os.environ.update(env)
+
+    server = None
+    try:
+        print(f'Seeding {workdir} ...')
+        started = time.perf_counter()
+        seed(args, workdir)
+        print(f'Seeded in {time.perf_counter() - started:.1f} s; starting gunicorn on port {args.port}')
+        server = start_server(args, env)
+
+        results = {}
+        for name in names:
+            print(f'  {name} ...', flush=True)
+            results[name] = run_scenario(name, args)
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results, previous)
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nSaved {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import gc
+import os
+import time
+
+# gunicorn -c gunicorn.conf.py main:app
+#
+# The app is built once in the master (preload_app): folder setup, schema
+# checks, migrations and the search index run once per deploy instead of
+# once per worker, and workers are forked from the loaded app so they share
+# its memory copy-on-write. Each worker opens its own database connections
+# and background threads after the fork (see register_at_fork in engine.py
+# and background.py).
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# Each open live leaderboard stream holds one gthread thread while it idles
+# on a condition variable (no CPU, no database). Workers get that many
+# threads on top of the ones for ordinary requests, and the app refuses
+# streams beyond it, so game pages can never starve the rest of the site.
+stream_threads = int(os.environ.get('LEADERBOARD_STREAM_MAX_CLIENTS', 32))
+os.environ['LEADERBOARD_STREAM_MAX_CLIENTS'] = str(stream_threads)
+threads += stream_threads
+worker_class = 'gthread'
+timeout = 30
+preload_app = True
+accesslog = '-'
+
+
+def pre_fork(server, worker):
+    # Objects loaded so far are never collected in the workers; freezing
+    # them keeps the collector from touching (and so copying) their pages
+    gc.freeze()
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    worker.log.info('Worker %s ready in %.0f ms', worker.pid,
+                    (time.perf_counter() - worker.forked_at) * 1000)
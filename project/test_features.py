@@ -0,0 +1,1281 @@
+import atexit
+import hashlib
+import io
+import json
+import logging
+import logging.handlers
+import os
+import tempfile
+import threading
+import zipfile
+import zlib
+
+# Checks for the features behind the app, one section per area.
+# Runs on a throwaway database and upload folders:
+#   python test_features.py      (or: python -m pytest test_features.py)
+
+try:
+    import brotli
+except ImportError:  # optional, as in the app
+    brotli = None
+
+workdir = tempfile.mkdtemp(prefix='website-test-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'test.db')}"
+os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+os.environ['GAMES_FOLDER'] = os.path.join(workdir, 'games')
+
+from datetime import datetime, timedelta
+from flask import Flask, url_for
+from werkzeug.datastructures import FileStorage
+from website import create_app, db, prepare_app
+from website.blobstore import blob_path, release_upload, remove_released, store_upload
+from website.assets import IMMUTABLE, REVALIDATE, compress_static_files
+from website.engine import load_engine_config
+from website.instrumentation import record_upload
+from website import identity
+from sqlalchemy import text
+from website.leaderboard import get_leaderboard, record_score
+from website.leaderboard_stream import leaderboard_diff, leaderboard_publisher
+from website.thumbnails import InvalidImage, generate_variants, profile_pic_variants, variant_name
+from website.search import FTS_TABLE, search_notes
+from website import games, passwords
+from website.counters import download_counter
+from website.fragments import FRAGMENT_HITS, FRAGMENT_MISSES, FragmentCache, content_version
+from website.extraction import UnsupportedDocument, extract_text, extraction_pool
+from website.ordering import GAP, apply_order, move_item, next_position, rebalance_positions
+from website.migrations import run_data_migrations, upgrade_database
+from website.models import Blob, DocumentText, Game, Student, FlappyBest, FlappyScore, FlappyStats, Note, User
+from website.score_queue import InvalidScore, score_queue
+
+app = create_app()
+app.testing = True
+
+
+def _client(email):
+    client = app.test_client()
+    client.post('/sign-up', data={'email': email, 'firstName': 'Test',
+                                  'password1': 'password1', 'password2': 'password1'})
+    client.post('/login', data={'email': email, 'password': 'password1'})
+    return client
+
+
+def _user(email):
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        user = User(email=email, first_name=email.split('@')[0], password='x')
+        db.session.add(user)
+        db.session.commit()
+    return user
+
+
+def _students(user, count):
+    for i in range(count):
+        db.session.add(Student(name=f'S{i}', age=10, contact='1', class_section='A',
+                               user_id=user.id, position=next_position(Student, user.id)))
+        db.session.commit()
+    return [s.id for s in Student.query.filter_by(user_id=user.id).order_by(Student.position)]
+
+
+def _order(user):
+    return [s.id for s in Student.query.filter_by(user_id=user.id).order_by(Student.position, Student.id)]
+
+
+def _stats():
+    stats = db.session.get(FlappyStats, 1)
+    db.session.refresh(stats)
+    return stats
+
+
+# ---------------- LEADERBOARD -----------------
+def test_leaderboard_keeps_best_per_player():
+    with app.app_context():
+        now = datetime.utcnow()
+        for score in (5, 9, 3):
+            record_score('best-ann', score, None, now)
+        record_score('best-bob', 7, None, now)
+        db.session.commit()
+
+        rows = FlappyBest.query.filter(FlappyBest.player_name.like('best-%')).all()
+        assert {row.player_name: row.score for row in rows} == {'best-ann': 9, 'best-bob': 7}
+        top, _ = get_leaderboard(100)
+        names = [row.player_name for row in top if row.player_name.startswith('best-')]
+        assert names == ['best-ann', 'best-bob']
+
+
+def test_leaderboard_counters():
+    with app.app_context():
+        before = _stats()
+        played, players = before.games_played, before.total_players
+        today_games, today_players = before.games_today, before.players_today
+
+        now = datetime.utcnow()
+        record_score('count-ann', 1, None, now)
+        record_score('count-ann', 2, None, now)
+        record_score('count-bob', 3, None, now)
+        db.session.commit()
+        stats = _stats()
+        assert stats.games_played == played + 3
+        assert stats.total_players == players + 2
+        assert stats.games_today == today_games + 3
+        assert stats.players_today == today_players + 2
+
+        # A retried score from yesterday counts toward the totals only
+        record_score('count-ann', 50, None, now - timedelta(days=1))
+        record_score('count-old', 4, None, now - timedelta(days=1))
+        db.session.commit()
+        stats = _stats()
+        assert stats.stats_day == now.date()
+        assert stats.games_played == played + 5
+        assert stats.total_players == players + 3
+        assert stats.games_today == today_games + 3
+        assert stats.players_today == today_players + 2
+        assert FlappyBest.query.filter_by(player_name='count-ann').one().score == 50
+
+
+def test_leaderboard_polls_get_304_until_a_score_lands():
+    client = _client('etag@example.com')
+    first = client.get('/flappy-leaderboard')
+    assert first.status_code == 200 and first.headers['ETag']
+    assert first.get_json()['success']
+
+    again = client.get('/flappy-leaderboard', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304 and not again.data
+
+    assert client.post('/submit-flappy-score', json={'score': 12}).status_code == 200
+    fresh = client.get('/flappy-leaderboard', headers={'If-None-Match': first.headers['ETag']})
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] != first.headers['ETag']
+
+
+# ---------------- SCORE QUEUE -----------------
+def test_score_validation():
+    with app.app_context():
+        for bad in ('abc', None, 2.5, -1, 10 ** 30, True, [1]):
+            try:
+                score_queue.validate(bad)
+            except InvalidScore:
+                continue
+            raise AssertionError(f'accepted {bad!r}')
+        assert score_queue.validate('12') == 12
+
+    client = _client('scores@example.com')
+    assert client.post('/submit-flappy-score', json={'score': 'abc'}).status_code == 400
+
+
+def test_failed_batch_keeps_good_scores():
+    with app.app_context():
+        before = FlappyScore.query.count()
+    app.testing = False
+    try:
+        now = datetime.utcnow()
+        # A row that slipped past validation fails the batch (it can't be
+        # compared with the player's best score)
+        score_queue._pending.extend([('good', 5, None, now, 0), ('good', 'zzz', None, now, 0),
+                                     ('good', 6, None, now, 0)])
+        score_queue.flush()
+        assert score_queue.pending() == 1  # the bad row waits for another try
+        for _ in range(app.config['SCORE_QUEUE_MAX_ATTEMPTS']):
+            score_queue.flush()
+        assert score_queue.pending() == 0  # and is dropped after the last one
+    finally:
+        app.testing = True
+    with app.app_context():
+        assert FlappyScore.query.count() == before + 2
+
+
+
+# ---------------- SCHEMA UPGRADES -----------------
+def test_upgrade_adds_missing_columns_and_indexes():
+    with app.app_context():
+        # An older database file: an index and a column it never had
+        with db.engine.begin() as conn:
+            conn.execute(text('DROP INDEX ix_note_public_date'))
+            conn.execute(text('ALTER TABLE student DROP COLUMN contact'))
+
+        changes = upgrade_database()
+        assert 'index ix_note_public_date' in changes
+        assert 'column student.contact' in changes
+        assert upgrade_database() == []
+        assert run_data_migrations() == []
+
+        plan = ' '.join(row[-1] for row in db.session.execute(text(
+            'EXPLAIN QUERY PLAN SELECT id FROM note WHERE public = 1 ORDER BY date DESC LIMIT 20')))
+        assert 'ix_note_public_date' in plan, plan
+
+
+
+# ---------------- DATABASE ENGINE -----------------
+def test_connections_get_the_pragmas():
+    with app.app_context():
+        with db.engine.connect() as conn:
+            def pragma(name):
+                return conn.exec_driver_sql(f'PRAGMA {name}').scalar()
+            assert pragma('journal_mode') == 'wal'
+            assert pragma('synchronous') == 1  # NORMAL
+            assert pragma('busy_timeout') == app.config['SQLITE_BUSY_TIMEOUT_MS']
+        assert db.engine.pool.size() == app.config['DB_POOL_SIZE']
+
+
+def test_engine_settings_come_from_the_environment():
+    os.environ['SQLITE_BUSY_TIMEOUT_MS'] = '1234'
+    try:
+        other = Flask(__name__)
+        other.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///other.db'
+        load_engine_config(other)
+    finally:
+        del os.environ['SQLITE_BUSY_TIMEOUT_MS']
+    assert other.config['SQLITE_BUSY_TIMEOUT_MS'] == 1234
+    assert other.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] == other.config['DB_POOL_SIZE']
+
+    memory = Flask(__name__)
+    memory.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    load_engine_config(memory)
+    assert 'pool_size' not in memory.config['SQLALCHEMY_ENGINE_OPTIONS']
+
+
+
+# ---------------- PAGINATION -----------------
+def test_notes_pages_are_bounded_and_complete():
+    client = _client('pages@example.com')
+    with app.app_context():
+        user = User.query.filter_by(email='pages@example.com').one()
+        now = datetime.utcnow()
+        db.session.add_all(Note(data=f'n{i}', public=True, subject='Paging', user_id=user.id,
+                                date=now - timedelta(minutes=i // 2)) for i in range(25))
+        db.session.add(Note(data='private', public=False, subject='Paging', user_id=user.id, date=now))
+        db.session.commit()
+
+    assert len(client.get('/api/notes?limit=-2').get_json()['notes']) == 1
+    assert len(client.get('/api/notes?limit=100000').get_json()['notes']) <= app.config['NOTES_MAX_PAGE_SIZE']
+    assert client.get('/api/notes?cursor=garbage').status_code == 400
+
+    # Rows sharing a date are neither skipped nor repeated across pages
+    seen, cursor = [], ''
+    while True:
+        page = client.get(f'/api/notes?subject=Paging&limit=7&cursor={cursor}').get_json()
+        seen += [note['id'] for note in page['notes']]
+        assert all(note['data'] != 'private' for note in page['notes'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 25
+
+
+
+# ---------------- UPLOADS -----------------
+def _tmp_parts():
+    return [name for name in os.listdir(app.config['UPLOAD_TMP_FOLDER']) if name.endswith('.part')]
+
+
+def test_upload_size_limits():
+    client = _client('limits@example.com')
+    too_big = b'x' * (app.config['UPLOAD_SIZE_LIMITS']['txt'] + 1)
+    before = _tmp_parts()
+
+    response = client.post('/upload', data={'file': (io.BytesIO(too_big), 'big.txt')})
+    assert response.status_code == 302  # back to the form with a message
+
+    response = client.post('/upload', data={'file': (io.BytesIO(too_big), 'big.txt')},
+                           headers={'Accept': 'application/json'})
+    assert response.status_code == 413
+    assert 'limit' in response.get_json()['error']
+    assert _tmp_parts() == before  # the partial file is gone
+
+    # The same size is fine for a type with a higher limit
+    response = client.post('/upload', data={'file': (io.BytesIO(too_big), 'big.pdf')})
+    assert response.status_code == 302
+    with app.app_context():
+        assert Note.query.filter_by(original_name='big.pdf').count() == 1
+
+
+
+# ---------------- BLOB STORE -----------------
+def _store(data, name):
+    return store_upload(FileStorage(io.BytesIO(data), filename=name))
+
+
+def test_blob_dedup_and_release():
+    with app.test_request_context():
+        first = _store(b'same bytes', 'a.txt')
+        second = _store(b'same bytes', 'b.txt')
+        other = _store(b'other bytes', 'c.txt')
+        db.session.commit()
+        assert first == second != other
+        assert Blob.query.filter_by(name=first).one().ref_count == 2
+        assert os.path.exists(blob_path(first))
+
+        # The file goes only with its last reference
+        assert release_upload(first) is None
+        db.session.commit()
+        assert Blob.query.filter_by(name=first).one().ref_count == 1
+        released = release_upload(first)
+        assert released == blob_path(first)
+        db.session.commit()
+        assert Blob.query.filter_by(name=first).first() is None
+        assert remove_released(released) and not os.path.exists(released)
+
+        # Uploading it again brings the file back
+        assert _store(b'same bytes', 'd.txt') == first
+        db.session.commit()
+        assert os.path.exists(blob_path(first))
+
+
+def test_reupload_between_delete_and_unlink_keeps_the_file():
+    with app.test_request_context():
+        name = _store(b'reuploaded', 'a.txt')
+        db.session.commit()
+        released = release_upload(name)
+        db.session.commit()
+
+        # The same content arrives again before the delete unlinks it
+        assert _store(b'reuploaded', 'b.txt') == name
+        db.session.commit()
+        assert not remove_released(released)
+        assert os.path.exists(released)
+
+    # An upload still in flight holds the write lock, so the unlink waits
+    # for it and then sees its row
+    stored, done = threading.Event(), threading.Event()
+
+    def upload():
+        with app.test_request_context():
+            _store(b'in flight', 'c.txt')
+            stored.set()
+            done.wait(0.3)
+            db.session.commit()
+
+    with app.test_request_context():
+        name = _store(b'in flight', 'a.txt')
+        db.session.commit()
+        released = release_upload(name)
+        db.session.commit()
+
+        thread = threading.Thread(target=upload)
+        thread.start()
+        stored.wait(5)
+        assert not remove_released(released)
+        thread.join()
+        assert os.path.exists(released)
+        assert Blob.query.filter_by(name=name).one().ref_count == 1
+
+
+
+# ---------------- THUMBNAILS -----------------
+def _png(size=(400, 300)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGBA', size, (200, 30, 30, 128)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_profile_pictures_get_thumbnails():
+    with app.test_request_context():
+        name = _store(_png(), 'face.png')
+        db.session.commit()
+        assert generate_variants(name) > 0
+        small = variant_name(name, app.config['THUMBNAIL_SIZES'][0], 'jpg')
+        assert os.path.exists(blob_path(small))
+        assert small in profile_pic_variants(name)['src']
+        assert generate_variants(name) == 0  # nothing missing
+
+        # Another worker deleted the variants: the disk is asked, not a memo
+        os.remove(blob_path(small))
+        assert name in profile_pic_variants(name)['src']
+        assert generate_variants(name) == 1
+        assert os.path.exists(blob_path(small))
+
+
+def test_undecodable_profile_picture_is_refused():
+    client = _client('pics@example.com')
+    form = {'name': 'Pic', 'age': '10', 'contact': '1', 'class_section': 'A'}
+    with app.app_context():
+        blobs = Blob.query.count()
+
+    response = client.post('/add-student', data={**form, 'profile_pic': (io.BytesIO(b'not a png'), 'x.png')})
+    assert b'Profile picture must be an image' in response.data
+    with app.app_context():
+        assert Blob.query.count() == blobs
+        try:
+            generate_variants('x.png', source=io.BytesIO(b'not a png'))
+        except InvalidImage:
+            pass
+        else:
+            raise AssertionError('decoded a file that is not an image')
+
+    response = client.post('/add-student', data={**form, 'profile_pic': (io.BytesIO(_png()), 'ok.png')})
+    assert response.status_code == 302
+    with app.app_context():
+        student = Student.query.filter_by(name='Pic').one()
+        assert os.path.exists(blob_path(variant_name(student.profile_pic, app.config['THUMBNAIL_SIZES'][0], 'jpg')))
+
+
+
+# ---------------- STATIC FILES -----------------
+def test_static_urls_are_fingerprinted():
+    with app.test_request_context():
+        url = url_for('static', filename='index.js')
+    assert '?v=' in url
+    client = app.test_client()
+
+    fresh = client.get(url)
+    assert fresh.status_code == 200 and fresh.headers['Cache-Control'] == IMMUTABLE
+    fresh.close()
+    for stale in ('/static/index.js', '/static/index.js?v=000000000000'):
+        response = client.get(stale)
+        assert response.headers['Cache-Control'] == REVALIDATE and response.headers['ETag']
+        again = client.get(stale, headers={'If-None-Match': response.headers['ETag']})
+        assert again.status_code == 304
+        response.close()
+    assert client.get('/static/../__init__.py').status_code == 404
+
+
+def test_static_files_are_precompressed_once():
+    folder = os.path.join(workdir, 'static')
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'app.js'), 'w') as f:
+        f.write('console.log(1);\n' * 200)
+    with open(os.path.join(folder, 'tiny.js'), 'w') as f:
+        f.write('1')
+    written = compress_static_files(folder)
+    assert written >= 1
+    assert os.path.exists(os.path.join(folder, 'app.js.gz'))
+    assert not os.path.exists(os.path.join(folder, 'tiny.js.gz'))
+    assert compress_static_files(folder) == 0
+
+
+
+# ---------------- HOME PAGE AND USER CACHE -----------------
+def test_home_queries_do_not_grow_with_notes():
+    client = _client('home@example.com')
+    app.config['QUERY_COUNT_HEADER'] = True
+    try:
+        def queries():
+            response = client.get('/')
+            assert response.status_code == 200
+            return int(response.headers['X-Query-Count'])
+
+        def add_notes(count):
+            with app.app_context():
+                user = User.query.filter_by(email='home@example.com').one()
+                db.session.add_all(Note(data=f'home {i}', user_id=user.id) for i in range(count))
+                db.session.commit()
+
+        queries()  # loads (and caches) the user
+        add_notes(3)
+        few = queries()
+        add_notes(30)
+        assert queries() == few == 1  # the notes, with the user from the cache
+    finally:
+        app.config['QUERY_COUNT_HEADER'] = False
+
+
+def test_user_cache_drops_changed_users():
+    with app.app_context():
+        user = User(email='cache@example.com', first_name='Before', password='x')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        db.session.remove()
+
+        assert identity.load_cached_user(user_id).first_name == 'Before'
+        db.session.remove()
+        db.session.get(User, user_id).first_name = 'After'
+        db.session.commit()
+        db.session.remove()
+        assert identity.load_cached_user(user_id).first_name == 'After'
+
+        db.session.delete(db.session.get(User, user_id))
+        db.session.commit()
+        db.session.remove()
+        assert identity.load_cached_user(user_id) is None
+
+
+def test_user_cache_is_bounded():
+    app.config['USER_CACHE_MAX_ENTRIES'] = 2
+    try:
+        with app.app_context():
+            users = [User(email=f'lru{i}@example.com', first_name='Lru', password='x') for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+            for user in users:
+                identity.load_cached_user(user.id)
+            assert list(identity._users)[-2:] == [users[1].id, users[2].id]
+            assert len(identity._users) == 2
+    finally:
+        app.config['USER_CACHE_MAX_ENTRIES'] = 10000
+
+
+
+# ---------------- ORDERING -----------------
+def test_move_writes_one_row():
+    with app.app_context():
+        user = _user('order1@example.com')
+        ids = _students(user, 4)
+        assert [s.position for s in Student.query.filter_by(user_id=user.id)
+                .order_by(Student.position)] == [GAP, 2 * GAP, 3 * GAP, 4 * GAP]
+
+        updated = move_item(Student, user.id, ids[3], 0)
+        db.session.commit()
+        assert updated == 1
+        assert _order(user) == [ids[3], ids[0], ids[1], ids[2]]
+
+        assert move_item(Student, user.id, 999999, 0) is None
+
+
+def test_full_reorder_keeps_sorted_rows():
+    with app.app_context():
+        user = _user('order2@example.com')
+        ids = _students(user, 5)
+        # Only the moved row needs a new position; junk and foreign ids are ignored
+        updated = apply_order(Student, user.id, [ids[0], ids[2], ids[3], ids[4], ids[1], 'x', -1])
+        db.session.commit()
+        assert updated == 1
+        assert _order(user) == [ids[0], ids[2], ids[3], ids[4], ids[1]]
+
+
+def test_exhausted_gap_rebalances():
+    with app.app_context():
+        user = _user('order3@example.com')
+        ids = _students(user, 3)
+        for position, student_id in enumerate(ids, start=1):
+            db.session.get(Student, student_id).position = position  # no room between neighbours
+        db.session.commit()
+
+        move_item(Student, user.id, ids[2], 1)
+        db.session.commit()
+        assert _order(user) == [ids[0], ids[2], ids[1]]
+        positions = [db.session.get(Student, i).position for i in _order(user)]
+        assert positions == [GAP, 2 * GAP, 3 * GAP]
+
+        db.session.get(Student, ids[0]).position = 7
+        db.session.commit()
+        rebalance_positions(Student, user.id)
+        db.session.commit()
+        assert [db.session.get(Student, i).position for i in _order(user)] == [GAP, 2 * GAP, 3 * GAP]
+
+
+def test_repeated_moves_into_one_spot_stay_ordered():
+    with app.app_context():
+        user = _user('order4@example.com')
+        ids = _students(user, 3)
+        # Each move halves the gap after the first row until it runs out
+        expected = list(ids)
+        for _ in range(15):
+            moved = expected.pop()
+            expected.insert(1, moved)
+            move_item(Student, user.id, moved, 1)
+            db.session.commit()
+            assert _order(user) == expected
+        assert next_position(Student, user.id) > max(
+            db.session.get(Student, i).position for i in ids)
+
+
+def test_reorder_route_cost_does_not_grow_with_the_roster():
+    client = _client('reorder@example.com')
+    app.config['QUERY_COUNT_HEADER'] = True
+    try:
+        def move(student_id, index):
+            response = client.post('/reorder-students', json={'move': {'id': student_id, 'index': index}})
+            return response, int(response.headers['X-Query-Count'])
+
+        with app.app_context():
+            user = User.query.filter_by(email='reorder@example.com').one()
+            ids = _students(user, 5)
+        move(ids[4], 0)  # loads (and caches) the user
+        small = move(ids[3], 0)[1]
+        with app.app_context():
+            ids = _students(user, 40)
+        response, large = move(ids[-1], 0)
+        assert response.get_json() == {'success': True, 'updated': 1}
+        assert large == small
+
+        with app.app_context():
+            foreign = _students(_user('reorder-other@example.com'), 1)[0]
+        assert move(foreign, 0)[0].status_code == 404
+    finally:
+        app.config['QUERY_COUNT_HEADER'] = False
+
+
+
+# ---------------- ROSTERS -----------------
+def test_roster_pages_are_bounded():
+    client = _client('roster@example.com')
+    with app.app_context():
+        _students(User.query.filter_by(email='roster@example.com').one(), 3)
+    assert len(client.get('/api/students?limit=-5').get_json()['items']) == 1
+    assert client.get('/api/students?cursor=%%%').status_code == 400
+
+
+def test_roster_filter_and_name_search():
+    client = _client('search@example.com')
+    with app.app_context():
+        user = User.query.filter_by(email='search@example.com').one()
+        for name, section in [('Zara Quill', 'Q1'), ('zane quill', 'Q2'), ('Zed_Q', 'Q1'),
+                              ('Élodie Q', 'Q1'), ('ÖZ Q', 'Q2'), ('Zo%Q', 'Q2')]:
+            db.session.add(Student(name=name, age=10, contact='1', class_section=section,
+                                   user_id=user.id, position=next_position(Student, user.id)))
+        db.session.commit()
+
+    def names(query):
+        response = client.get('/api/students?limit=100&' + query)
+        assert response.status_code == 200, query
+        return sorted(item['name'] for item in response.get_json()['items'])
+
+    assert names('class_section=Q1&q=z') == ['Zara Quill', 'Zed_Q']
+    assert names('q=ZA') == ['Zara Quill', 'zane quill']
+    # LIKE wildcards in the search are taken literally
+    assert names('q=zed_') == ['Zed_Q']
+    assert names('q=ze%') == []
+    assert names('q=zo%25') == ['Zo%Q']
+    # Non-ASCII names match whatever the case of the search
+    assert names('q=élo') == ['Élodie Q']
+    assert names('q=ÉLO') == ['Élodie Q']
+    assert names('q=öz') == ['ÖZ Q']
+    # The last code point has no successor; it used to raise a 500
+    assert names('q=%F4%8F%BF%BF') == []
+    assert client.get('/stdu?q=%F4%8F%BF%BF').status_code == 200
+    assert client.get('/stdu?q=%C3%A9lo').status_code == 200
+
+
+
+# ---------------- NOTE SEARCH -----------------
+def test_search_index_follows_note_writes():
+    with app.app_context():
+        owner, other = _user('fts-owner@example.com'), _user('fts-other@example.com')
+
+        def found(query, user=owner, **kwargs):
+            return [note.data for note in search_notes(user.id, query, **kwargs)['notes']]
+
+        note = Note(data='photosynthesis in leaves', subject='Biology', user_id=owner.id)
+        db.session.add(note)
+        db.session.commit()
+        assert found('photosynth') == ['photosynthesis in leaves']  # prefix match
+        assert found('photosynthesis', user=other) == []  # private
+
+        note.public = True
+        db.session.commit()
+        assert found('photosynthesis', user=other) == ['photosynthesis in leaves']
+        assert found('photosynthesis', user=other, scope='mine') == []
+
+        note.data = 'chlorophyll in leaves'
+        db.session.commit()
+        assert found('photosynthesis') == []
+        assert found('chlorophyll') == ['chlorophyll in leaves']
+        result = search_notes(owner.id, 'leaves')
+        assert result['facets'] == [{'subject': 'Biology', 'count': 1}] and result['total'] == 1
+
+        db.session.delete(note)
+        db.session.commit()
+        assert found('chlorophyll') == []
+
+        # FTS5 syntax in the query is searched for as words, not parsed
+        for query in ('"', 'a OR', 'NEAR(', '*', 'x AND -y', ''):
+            assert search_notes(owner.id, query)['notes'] == []
+
+
+def test_search_pages():
+    client = _client('fts-pages@example.com')
+    with app.app_context():
+        user = User.query.filter_by(email='fts-pages@example.com').one()
+        db.session.add_all(Note(data=f'mitochondria {i}', user_id=user.id) for i in range(25))
+        db.session.commit()
+    first = client.get('/api/search?q=mitochondria').get_json()
+    assert first['total'] == 25 and first['has_more'] and len(first['notes']) == app.config['SEARCH_PAGE_SIZE']
+    last = client.get('/api/search?q=mitochondria&page=2').get_json()
+    assert not last['has_more']
+    assert len({n['id'] for n in first['notes']} | {n['id'] for n in last['notes']}) == 25
+    assert client.get('/search?q=mitochondria').status_code == 200
+
+
+
+# ---------------- DOCUMENT TEXT -----------------
+def _docx(text):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('word/document.xml', (
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:body></w:document>'))
+    return buffer.getvalue()
+
+
+def test_uploaded_documents_are_extracted_and_searchable():
+    client = _client('docs@example.com')
+    client.post('/upload', data={'file': (io.BytesIO(_docx('ribosome assembly')), 'cell.docx')})
+    client.post('/upload', data={'file': (io.BytesIO(b'  golgi \n \n\n\n  apparatus  '), 'cell.txt')})
+    # The same file again reuses the extracted text
+    client.post('/upload', data={'file': (io.BytesIO(_docx('ribosome assembly')), 'copy.docx')})
+
+    with app.app_context():
+        user = User.query.filter_by(email='docs@example.com').one()
+        notes = Note.query.filter_by(user_id=user.id).order_by(Note.id).all()
+        assert [note.file_text for note in notes] == ['ribosome assembly', 'golgi\n\napparatus',
+                                                      'ribosome assembly']
+        assert {doc.status for doc in DocumentText.query.filter(
+            DocumentText.file_name.in_([note.file_name for note in notes]))} == {'done'}
+        assert len(search_notes(user.id, 'ribosome')['notes']) == 2
+        assert len(search_notes(user.id, 'apparatus')['notes']) == 1
+
+
+def test_broken_documents_are_marked_unsupported():
+    path = os.path.join(workdir, 'empty.docx')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('other.xml', '<x/>')
+    try:
+        extract_text(path, 'empty.docx', 1000)
+    except UnsupportedDocument:
+        pass
+    else:
+        raise AssertionError('extracted a file without word/document.xml')
+
+
+def test_extraction_is_claimed_once():
+    with app.app_context():
+        now = datetime.utcnow()
+        db.session.add_all([
+            DocumentText(file_name='blobs/aa/claimed.txt', status='running', updated_at=now),
+            DocumentText(file_name='blobs/aa/stale.txt', status='running',
+                         updated_at=now - timedelta(seconds=app.config['EXTRACTION_CLAIM_SECONDS'] + 1)),
+        ])
+        db.session.commit()
+
+        # Another worker is on it: nothing to do here
+        assert extraction_pool.process('blobs/aa/claimed.txt') == 'running'
+        assert DocumentText.query.filter_by(file_name='blobs/aa/claimed.txt').one().attempts == 0
+        # Its worker died: the claim is taken over (the file is missing, so it fails)
+        assert extraction_pool.process('blobs/aa/stale.txt') == 'failed'
+        assert extraction_pool.resume() == 0
+
+
+
+# ---------------- GAME DOWNLOADS -----------------
+def _upload_game(client, name, data, title='Game'):
+    return client.post('/upload-game', data={
+        'title': title, 'description': 'd', 'instructions': 'i', 'game_type': 'desktop',
+        'game_file': (io.BytesIO(data), name)})
+
+
+def test_game_downloads_are_counted_once_per_full_transfer():
+    client = _client('downloads@example.com')
+    data = b'print("hello")\n' * 20
+    assert _upload_game(client, 'hello.py', data, title='Counted').status_code == 302
+    with app.app_context():
+        game_id = Game.query.filter_by(title='Counted').one().id
+
+    def downloads():
+        with app.app_context():
+            return db.session.get(Game, game_id).downloads or 0
+
+    url = f'/download-game/{game_id}'
+    full = client.get(url)
+    assert full.status_code == 200 and full.data == data
+    assert full.headers['ETag'] == f'"{hashlib.sha256(data).hexdigest()}"'
+    assert 'filename=hello.py' in full.headers['Content-Disposition']
+    assert downloads() == 1
+
+    assert client.get(url, headers={'If-None-Match': full.headers['ETag']}).status_code == 304
+    assert client.head(url).status_code == 200
+    assert downloads() == 1  # revalidation and HEAD don't count
+
+    first = client.get(url, headers={'Range': 'bytes=0-9'})
+    assert first.status_code == 206 and first.data == data[:10]
+    assert downloads() == 2
+    rest = client.get(url, headers={'Range': 'bytes=10-', 'If-Range': full.headers['ETag']})
+    assert rest.status_code == 206 and rest.data == data[10:]
+    assert downloads() == 2  # the resumed part isn't a new download
+
+
+def test_download_counts_are_batched():
+    client = _client('batched@example.com')
+    _upload_game(client, 'batched.py', b'print(2)\n', title='Batched')
+    with app.app_context():
+        game_id = Game.query.filter_by(title='Batched').one().id
+
+    app.testing = False
+    try:
+        for _ in range(3):
+            client.get(f'/download-game/{game_id}').close()
+        assert download_counter.pending(game_id) == 3
+        assert download_counter.flush() == 3
+    finally:
+        app.testing = True
+    with app.app_context():
+        assert db.session.get(Game, game_id).downloads == 3
+
+
+
+# ---------------- GAME UPLOADS -----------------
+def _zip(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+    path = os.path.join(workdir, f'archive-{len(entries)}-{abs(hash(tuple(entries)))}.zip')
+    with open(path, 'wb') as f:
+        f.write(buffer.getvalue())
+    return path
+
+
+def test_archive_paths_are_checked():
+    with app.app_context():
+        manifest = games.inspect_archive(_zip([('index.html', '<p>hi</p>'), ('js/app.js', '1')]))
+        assert [f['path'] for f in manifest['files']] == ['index.html', 'js/app.js']
+
+        for entries in ([('../evil.py', 'x')], [('/etc/evil', 'x')], [('C:/evil', 'x')],
+                        [('a/../../evil', 'x')], [('a.py', 'x'), ('./a.py', 'y')], []):
+            try:
+                games.inspect_archive(_zip(entries))
+            except games.InvalidGameArchive:
+                continue
+            raise AssertionError(f'accepted {entries!r}')
+
+        not_zip = os.path.join(workdir, 'not.zip')
+        with open(not_zip, 'wb') as f:
+            f.write(b'not a zip')
+        try:
+            games.inspect_archive(not_zip)
+        except games.InvalidGameArchive:
+            pass
+        else:
+            raise AssertionError('accepted a file that is not a zip')
+
+
+def test_web_games_are_unpacked_before_their_row_is_written():
+    client = _client('games@example.com')
+    folder = app.config['GAMES_FOLDER']
+
+    def upload(entries, title):
+        with open(_zip(entries), 'rb') as f:
+            return client.post('/upload-game', data={
+                'title': title, 'description': 'd', 'instructions': 'i', 'game_type': 'web',
+                'game_file': (io.BytesIO(f.read()), 'game.zip')})
+
+    # Another connection can still write while the archive is unpacked
+    unpack = games._unpack
+
+    def unpack_while_writing(path, manifest):
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA busy_timeout=0')
+            try:
+                conn.exec_driver_sql('UPDATE flappy_stats SET id = id')
+                conn.commit()
+            finally:
+                conn.exec_driver_sql(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+        return unpack(path, manifest)
+
+    games._unpack = unpack_while_writing
+    try:
+        response = upload([('site/index.html', '<p>play</p>'), ('site/app.js', '1')], 'Web game')
+    finally:
+        games._unpack = unpack
+    assert response.status_code == 302
+
+    with app.app_context():
+        game = Game.query.filter_by(title='Web game').one()
+        assert game.entry_point == f'{game.id}/site/index.html'
+        assert game.total_size == len('<p>play</p>') + 1
+        with open(os.path.join(folder, game.entry_point)) as f:
+            assert f.read() == '<p>play</p>'
+        stored = game.filename
+
+    # A bad archive with the same name leaves no row, no files and the
+    # earlier game untouched
+    before = set(os.listdir(folder))
+    response = upload([('readme.txt', 'no index')], 'Broken game')
+    assert b'Invalid game archive' in response.data
+    assert set(os.listdir(folder)) == before
+    with app.app_context():
+        assert Game.query.filter_by(title='Broken game').first() is None
+    assert os.path.exists(os.path.join(folder, stored))
+
+
+
+# ---------------- COMPRESSION -----------------
+def test_pages_and_json_are_compressed():
+    client = app.test_client()
+    plain = client.get('/login')
+    assert 'Content-Encoding' not in plain.headers
+
+    gzipped = client.get('/login', headers={'Accept-Encoding': 'gzip'})
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in gzipped.headers['Vary']
+    assert zlib.decompress(gzipped.data, 31) == plain.data
+
+    if brotli is not None:
+        br = client.get('/login', headers={'Accept-Encoding': 'gzip, br'})
+        assert br.headers['Content-Encoding'] == 'br'
+        assert brotli.decompress(br.data) == plain.data
+    assert client.get('/login', headers={'Accept-Encoding': 'gzip;q=1, br;q=0.5'}
+                      ).headers['Content-Encoding'] == 'gzip'
+
+    # Files are left to send_file and assets.py
+    static = client.get('/static/index.js', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in static.headers
+    static.close()
+
+
+def test_compressed_json_keeps_conditional_requests_working():
+    client = _client('gzip@example.com')
+    with app.app_context():
+        user = User.query.filter_by(email='gzip@example.com').one()
+        db.session.add_all(Note(data='compressible ' * 20, public=True, user_id=user.id) for _ in range(10))
+        db.session.commit()
+
+    notes = client.get('/api/notes', headers={'Accept-Encoding': 'gzip'})
+    assert notes.headers['Content-Encoding'] == 'gzip'
+    assert len(notes.data) < int(len(zlib.decompress(notes.data, 31)) / 2)
+
+    board = client.get('/flappy-leaderboard', headers={'Accept-Encoding': 'gzip'})
+    etag = board.headers['ETag']
+    if board.headers.get('Content-Encoding'):
+        assert etag.startswith('W/')  # the compressed bytes differ from the hashed ones
+    again = client.get('/flappy-leaderboard', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert again.status_code == 304
+
+
+
+# ---------------- METRICS -----------------
+def test_metrics_are_closed_without_a_token():
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 404
+
+    app.config['METRICS_TOKEN'] = 'secret'
+    try:
+        assert client.get('/metrics').status_code == 401
+        assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        client.get('/login')
+        page = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    finally:
+        app.config['METRICS_TOKEN'] = None
+    assert page.status_code == 200
+    text = page.get_data(as_text=True)
+    assert 'http_requests_total{endpoint="auth.login",method="GET",status="200"}' in text
+    assert 'http_request_db_queries_bucket{endpoint="auth.login"' in text
+    assert 'score_queue_pending' in text
+
+
+def test_upload_metrics_have_bounded_labels():
+    def series():
+        app.config['METRICS_TOKEN'] = 'secret'
+        try:
+            text = app.test_client().get('/metrics', headers={'Authorization': 'Bearer secret'}).get_data(as_text=True)
+        finally:
+            app.config['METRICS_TOKEN'] = None
+        return {line.split(' ')[0]: float(line.split(' ')[1]) for line in text.splitlines()
+                if line.startswith('upload_bytes_total{')}
+
+    before = series()
+    client = _client('metrics@example.com')
+    client.post('/upload', data={'file': (io.BytesIO(b'12345'), 'a.txt')})
+    # The upload view refuses unknown types after staging, so record directly
+    with app.test_request_context('/upload', method='POST'):
+        record_upload('a.zzzz9', 3)
+    # Files sent to routes that don't take uploads aren't counted
+    app.test_client().post('/login', data={'email': 'x', 'file': (io.BytesIO(b'1234567'), 'b.txt')})
+    after = series()
+
+    def grew(label):
+        key = f'upload_bytes_total{{extension="{label}"}}'
+        return after.get(key, 0) - before.get(key, 0)
+
+    assert grew('txt') == 5
+    assert grew('other') == 3
+    assert not any('zzzz9' in key for key in after)
+
+
+
+# ---------------- PASSWORD HASHING -----------------
+def _count_hashes():
+    # Wrap the hash functions the hasher calls and count each call
+    calls = []
+    originals = passwords.generate_password_hash, passwords.check_password_hash
+
+    def generate(*args):
+        calls.append('hash')
+        return originals[0](*args)
+
+    def check(*args):
+        calls.append('check')
+        return originals[1](*args)
+
+    def restore():
+        passwords.generate_password_hash, passwords.check_password_hash = originals
+
+    passwords.generate_password_hash, passwords.check_password_hash = generate, check
+    return calls, restore
+
+
+def test_login_with_current_hash_hashes_once():
+    client = _client('current-hash@example.com')
+    client.get('/logout')
+    with app.app_context():
+        stored = User.query.filter_by(email='current-hash@example.com').one().password
+
+    calls, restore = _count_hashes()
+    try:
+        response = client.post('/login', data={'email': 'current-hash@example.com', 'password': 'password1'})
+    finally:
+        restore()
+    assert response.status_code == 302
+    assert calls == ['check']
+    with app.app_context():
+        assert User.query.filter_by(email='current-hash@example.com').one().password == stored
+
+
+def test_login_rehashes_when_the_method_changes():
+    client = _client('rehash@example.com')
+    client.get('/logout')
+    method = app.config['PASSWORD_HASH_METHOD']
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    try:
+        client.post('/login', data={'email': 'rehash@example.com', 'password': 'password1'})
+    finally:
+        app.config['PASSWORD_HASH_METHOD'] = method
+    with app.app_context():
+        assert User.query.filter_by(email='rehash@example.com').one().password.startswith('pbkdf2:sha256:1000$')
+
+
+def test_needs_rehash_matches_werkzeug_prefixes():
+    default = app.config['PASSWORD_HASH_METHOD']
+    with app.app_context():
+        for method in ('pbkdf2', 'pbkdf2:sha256', 'pbkdf2:sha512:1000', 'scrypt', 'scrypt:16384:8:1'):
+            pwhash = passwords.generate_password_hash('x', method)
+            app.config['PASSWORD_HASH_METHOD'] = method
+            try:
+                assert not passwords.password_hasher.needs_rehash(pwhash), method
+                app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+                assert passwords.password_hasher.needs_rehash(pwhash), method
+            finally:
+                app.config['PASSWORD_HASH_METHOD'] = default
+
+
+def test_full_hash_pool_answers_503():
+    client = _client('busy@example.com')
+    client.get('/logout')
+    hasher = passwords.password_hasher
+    release = threading.Event()
+    app.testing = False
+    app.config['PASSWORD_HASH_MAX_PENDING'] = 1
+    try:
+        with app.app_context():
+            blocker = threading.Thread(target=hasher._run, args=('check', release.wait))
+            blocker.start()
+            while hasher.pending() < 1:
+                release.wait(0.01)
+        response = client.post('/login', data={'email': 'busy@example.com', 'password': 'password1'})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(app.config['PASSWORD_HASH_RETRY_AFTER'])
+    finally:
+        release.set()
+        blocker.join()
+        app.config['PASSWORD_HASH_MAX_PENDING'] = 4 * app.config['PASSWORD_HASH_WORKERS']
+        app.testing = True
+    assert hasher.pending() == 0
+
+    # With room in the pool, the same login goes through the worker threads
+    app.testing = False
+    try:
+        response = client.post('/login', data={'email': 'busy@example.com', 'password': 'password1'})
+    finally:
+        app.testing = True
+    assert response.status_code == 302
+
+
+
+# ---------------- STARTUP -----------------
+def _database_state():
+    schema = db.session.execute(text('SELECT type, name, sql FROM sqlite_master ORDER BY name')).all()
+    counts = [db.session.execute(text(f'SELECT count(*) FROM {table}')).scalar()
+              for table in (FTS_TABLE, 'flappy_best', 'flappy_stats')]
+    return schema, counts
+
+
+def test_prepare_app_twice_changes_nothing():
+    with app.app_context():
+        before = _database_state()
+    prepare_app(app)
+    with app.app_context():
+        assert _database_state() == before
+
+
+def test_create_app_twice_registers_process_hooks_once():
+    services = (score_queue, leaderboard_publisher, download_counter, extraction_pool, passwords.password_hasher)
+    registered = {'atexit': 0, 'fork': 0}
+    register_exit, register_fork = atexit.register, os.register_at_fork
+
+    def count_exit(*args, **kwargs):
+        registered['atexit'] += 1
+        return register_exit(*args, **kwargs)
+
+    def count_fork(**kwargs):
+        registered['fork'] += 1
+        return register_fork(**kwargs)
+
+    atexit.register, os.register_at_fork = count_exit, count_fork
+    try:
+        second = create_app()
+    finally:
+        atexit.register, os.register_at_fork = register_exit, register_fork
+        # Point the shared services back at the app the other checks use
+        for service in services:
+            service.app = app
+
+    # Only the second app's own engine gets a hook (its pool is emptied in forked workers)
+    assert registered == {'atexit': 0, 'fork': 1}
+    handlers = logging.getLogger('website').handlers
+    assert sum(isinstance(handler, logging.handlers.QueueHandler) for handler in handlers) == 1
+    with second.app_context():
+        db.engine.dispose()
+
+
+
+# ---------------- LIVE LEADERBOARD -----------------
+def _read_event(chunks):
+    # Next event of an event stream, skipping heartbeats and the retry hint
+    while True:
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith('event:'):
+            lines = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+            return lines['event'], json.loads(lines['data'])
+
+
+def test_leaderboard_diff_lists_changed_ranks():
+    old = [{'name': 'a', 'score': 3}, {'name': 'b', 'score': 2}]
+    new = [{'name': 'c', 'score': 5}, {'name': 'a', 'score': 3}, {'name': 'b', 'score': 2}]
+    assert leaderboard_diff(old, new) == {
+        'changes': [{'rank': 0, 'entry': new[0]}, {'rank': 1, 'entry': new[1]}, {'rank': 2, 'entry': new[2]}],
+        'length': 3}
+    assert leaderboard_diff(new, new) == {'changes': [], 'length': 3}
+
+
+def test_leaderboard_stream_sends_snapshot_then_diff():
+    client = _client('stream@example.com')
+    response = client.get('/flappy-leaderboard/stream', buffered=False)
+    try:
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        assert leaderboard_publisher.clients() == 1
+        chunks = iter(response.response)
+        name, snapshot = _read_event(chunks)
+        assert name == 'snapshot'
+
+        with app.app_context():
+            record_score('stream-top', 10 ** 6, None)
+            db.session.commit()
+        leaderboard_publisher.notify()
+        name, diff = _read_event(chunks)
+        assert name == 'diff'
+        assert diff['changes'][0]['rank'] == 0
+        assert diff['changes'][0]['entry']['player_name'] == 'stream-top'
+        assert diff['length'] == min(10, len(snapshot['leaderboard']) + 1)
+    finally:
+        response.close()
+    assert leaderboard_publisher.clients() == 0
+
+
+def test_leaderboard_stream_limits_open_streams():
+    client = _client('stream-limit@example.com')
+    limit = app.config['LEADERBOARD_STREAM_MAX_CLIENTS']
+    app.config['LEADERBOARD_STREAM_MAX_CLIENTS'] = 1
+    try:
+        first = client.get('/flappy-leaderboard/stream', buffered=False)
+        second = client.get('/flappy-leaderboard/stream', buffered=False)
+        assert second.status_code == 503
+        assert second.headers['Retry-After'] == '30'
+        second.close()
+        first.close()
+        # The slot is freed on close even though the body was never read
+        third = client.get('/flappy-leaderboard/stream', buffered=False)
+        assert third.status_code == 200
+        third.close()
+    finally:
+        app.config['LEADERBOARD_STREAM_MAX_CLIENTS'] = limit
+    assert leaderboard_publisher.clients() == 0
+
+
+
+# ---------------- FRAGMENT CACHE -----------------
+def _fragments(kind):
+    return FRAGMENT_HITS._values.get((kind,), 0), FRAGMENT_MISSES._values.get((kind,), 0)
+
+
+def _grew(before, kind):
+    after = _fragments(kind)
+    return after[0] - before[0], after[1] - before[1]
+
+
+def test_roster_list_is_cached_until_the_table_changes():
+    client = _client('fragments@example.com')
+    with app.app_context():
+        ids = _students(_user('fragments@example.com'), 3)
+        version = content_version('student')
+
+    client.get('/stdu')
+    before = _fragments('list')
+    page = client.get('/stdu').get_data(as_text=True)
+    assert _grew(before, 'list') == (1, 0)
+    assert 'S2' in page
+
+    # An edit outside any request (another worker, the CLI) bumps the
+    # version in the database, so the next page misses and shows it
+    with app.app_context():
+        db.session.get(Student, ids[0]).name = 'Renamed'
+        db.session.commit()
+        assert content_version('student') == version + 1
+    before, rows = _fragments('list'), _fragments('row')
+    page = client.get('/stdu').get_data(as_text=True)
+    assert _grew(before, 'list') == (0, 1)
+    assert _grew(rows, 'row')[1] == 1  # only the edited card is rendered again
+    assert 'Renamed' in page
+
+    # Bulk statements skip the flush but bump the version too
+    with app.app_context():
+        move_item(Student, db.session.get(Student, ids[2]).user_id, ids[2], 0)
+        db.session.commit()
+        assert content_version('student') == version + 2
+
+
+def test_games_hub_list_is_shared_by_every_viewer():
+    _client('hub-a@example.com').get('/games')
+    before = _fragments('list')
+    _client('hub-b@example.com').get('/games')
+    assert _grew(before, 'list') == (1, 0)
+
+
+def test_fragment_cache_can_be_disabled():
+    client = _client('no-fragments@example.com')
+    app.config['FRAGMENT_CACHE_ENABLED'] = False
+    try:
+        before, rows = _fragments('list'), _fragments('row')
+        assert client.get('/stdu').status_code == 200
+        assert client.get('/games').status_code == 200
+    finally:
+        app.config['FRAGMENT_CACHE_ENABLED'] = True
+    assert _grew(before, 'list') == (0, 0)
+    assert _grew(rows, 'row') == (0, 0)
+
+
+def test_fragment_cache_evicts_least_recently_used():
+    cache = FragmentCache(max_bytes=10)
+    cache.set('a', 'aaaa', 4)
+    cache.set('b', 'bbbb', 4)
+    cache.get('a')
+    cache.set('c', 'cccc', 4)
+    assert cache.get('a') == 'aaaa' and cache.get('b') is None and cache.get('c') == 'cccc'
+    assert cache.size() == 8
+    cache.set('big', 'x' * 11, 11)  # larger than the whole cache: not kept
+    assert cache.get('big') is None and cache.size() == 8
+
+
+if __name__ == '__main__':
+    print("=== Testing Features ===")
+    failed = 0
+    for name, check in list(globals().items()):
+        if name.startswith('test_') and callable(check):
+            try:
+                check()
+                print(f"✅ {name}")
+            except Exception as e:
+                failed += 1
+                print(f"❌ {name}: {type(e).__name__}: {e}")
+    exit(1 if failed else 0)
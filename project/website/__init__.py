@@ -1,8 +1,9 @@
+import logging
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from os import path
+from sqlalchemy import inspect
 
 db = SQLAlchemy()
 DB_NAME = "database.db"
@@ -13,20 +14,97 @@ GAMES_FOLDER = os.path.join(os.path.dirname(__file__), 'static/games')
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'docx'}
 
+logger = logging.getLogger(__name__)
+
 def create_app():
+    # The only disk and database work is prepare_app() (folders, schema,
+    # migrations, search index), and every step in it checks first. Under
+    # gunicorn with preload_app (gunicorn.conf.py) create_app runs once in
+    # the master and workers are forked from the result.
+    from .instrumentation import StartupTimer
+    startup = StartupTimer()
+
     app = Flask(__name__)
+    app.extensions['startup_timer'] = startup
     app.config['SECRET_KEY'] = 'droduel23658'  # Consider using environment variable
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
-    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-    app.config['GAMES_FOLDER'] = GAMES_FOLDER
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f'sqlite:///{DB_NAME}')
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', UPLOAD_FOLDER)
+    app.config['GAMES_FOLDER'] = os.environ.get('GAMES_FOLDER', GAMES_FOLDER)
+    app.config['LEADERBOARD_CACHE_TTL'] = 5  # seconds
+    app.config['NOTES_PAGE_SIZE'] = 20
+    app.config['NOTES_MAX_PAGE_SIZE'] = 100
+    app.config['HOME_NOTES_LIMIT'] = 100
+    app.config['ROSTER_PAGE_SIZE'] = 24
+    app.config['ROSTER_MAX_PAGE_SIZE'] = 100
+    app.config['SEARCH_PAGE_SIZE'] = 20
+    app.config['USER_CACHE_TTL'] = 30  # seconds
+    app.config['USER_CACHE_MAX_ENTRIES'] = 10000
+    app.config['QUERY_COUNT_HEADER'] = os.environ.get('QUERY_COUNT_HEADER') == '1'
+
+    # Leveled logging through a background writer (LOG_LEVEL from env)
+    from .instrumentation import init_logging
+    init_logging(app)
+    startup.mark('config')
 
-    # Initialize SQLAlchemy with app
+    # Initialize SQLAlchemy with app (WAL, pragmas and pool size from env)
+    from .engine import load_engine_config, init_engine
+    load_engine_config(app)
     db.init_app(app)
+    init_engine(app)
+
+    # Count SQL queries per request (X-Query-Count header in debug)
+    from .instrumentation import init_query_counter
+    init_query_counter(app)
+    startup.mark('engine')
+
+    # Buffered writer for Flappy Bird scores
+    from .score_queue import score_queue
+    score_queue.init_app(app)
+
+    # Live leaderboard pushed to open game pages
+    from .leaderboard_stream import leaderboard_publisher
+    leaderboard_publisher.init_app(app)
+
+    # Batched game download counts
+    from .counters import download_counter
+    download_counter.init_app(app)
+
+    # Background text extraction for uploaded documents
+    from .extraction import extraction_pool
+    extraction_pool.init_app(app)
+
+    # Password hashing off the request thread, with admission control
+    from .passwords import password_hasher
+    password_hasher.init_app(app)
+
+    # Cached roster and games hub HTML, invalidated by writes to those tables
+    from .fragments import init_fragments
+    init_fragments(app)
+
+    # Request latency, SQL, template and upload metrics at /metrics
+    from .instrumentation import init_metrics
+    init_metrics(app)
+    startup.mark('extensions')
 
-    # Create folders if they don't exist
-    for folder in [UPLOAD_FOLDER, GAMES_FOLDER]:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+    # Stream uploads to disk in chunks with per-type size limits
+    from .uploads import init_uploads
+    init_uploads(app)
+
+    # gzip/brotli for rendered pages and JSON
+    from .compression import init_compression
+    init_compression(app)
+
+    # Fingerprinted static URLs, long-lived cache headers, precompressed assets
+    from .assets import init_assets
+    init_assets(app)
+
+    # Upload-time validation and unpacking of game archives
+    from .games import init_games
+    init_games(app)
+
+    # Small profile picture variants for the roster pages
+    from .thumbnails import init_thumbnails
+    init_thumbnails(app)
 
     # Import and register blueprints
     from .views import views
@@ -34,12 +112,14 @@ def create_app():
 
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
+    startup.mark('blueprints')
 
-    # Import models
-    from .models import User, Note
+    # Flask-Login's user loader, cached between requests
+    from .identity import load_cached_user
 
-    # Create database if it doesn't exist
-    create_database(app)
+    # Folders, schema and indexes; every step checks first
+    prepare_app(app)
+    startup.mark('database')
 
     # Login manager setup
     login_manager = LoginManager()
@@ -48,12 +128,37 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        return load_cached_user(int(id))
+
+    # flask CLI maintenance commands
+    from .commands import register_commands
+    register_commands(app)
 
+    startup.report()
     return app
 
+def prepare_app(app):
+    for folder in [app.config['UPLOAD_FOLDER'], app.config['GAMES_FOLDER'],
+                   app.config['UPLOAD_TMP_FOLDER']]:
+        os.makedirs(folder, exist_ok=True)
+    create_database(app)
+
 def create_database(app):
-    if not path.exists('website/' + DB_NAME):
-        with app.app_context():
-            db.create_all()
-        print('Created Database!')
\ No newline at end of file
+    with app.app_context():
+        created = set(db.metadata.tables) - set(inspect(db.engine).get_table_names())
+        db.create_all()
+
+        # Add columns and indexes that older database files are missing
+        from .migrations import run_data_migrations, upgrade_database
+        upgrade_database()
+        run_data_migrations()
+
+        # Full-text index over notes (created and filled on first start)
+        from .search import init_search
+        init_search()
+
+        # Backfill the leaderboard summary tables for existing databases
+        from .leaderboard import rebuild_leaderboard
+        rebuild_leaderboard()
+    if created:
+        logger.info('Created Database! (tables: %s)', ', '.join(sorted(created)))
\ No newline at end of file
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from flask import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are still used
+    brotli = None
+
+# Static files pipeline.
+#
+# url_for('static', filename=...) gets a ?v=<content hash> query parameter, so
+# the URL changes whenever the file does. Requests carrying the current hash
+# (and content-addressed uploads, whose path already is the hash) are served
+# with a one-year immutable Cache-Control; everything else is revalidated
+# with ETag/Last-Modified. Text assets are served from a precompressed .br or
+# .gz sibling when the client accepts it (see `flask compress-assets`).
+# Range and conditional requests are handled by send_file.
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.html', '.svg', '.json', '.txt', '.map', '.xml'}
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Content-addressed uploads (see blobstore/thumbnails) never change in place
+IMMUTABLE_PREFIXES = ('uploads/blobs/', 'uploads/thumbs/blobs/')
+
+# path -> (mtime_ns, size, version)
+_versions = {}
+
+
+def _static_path(filename):
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+
+def asset_version(filename):
+    path = _static_path(filename)
+    if path is None:
+        return None
+
+    stat = os.stat(path)
+    cached = _versions.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    version = digest.hexdigest()[:12]
+    _versions[path] = (stat.st_mtime_ns, stat.st_size, version)
+    return version
+
+
+def add_static_version(endpoint, values):
+    if endpoint != 'static' or 'v' in values:
+        return
+    filename = values.get('filename', '')
+    if filename.startswith(IMMUTABLE_PREFIXES):
+        return
+    version = asset_version(filename)
+    if version:
+        values['v'] = version
+
+
+def _precompressed(path):
+    if os.path.splitext(path)[1] not in COMPRESSIBLE_EXTENSIONS:
+        return None, None
+    accepted = request.accept_encodings
+    mtime = os.path.getmtime(path)
+    for encoding, suffix in ENCODINGS:
+        candidate = path + suffix
+        if accepted[encoding] and os.path.isfile(candidate) and os.path.getmtime(candidate) >= mtime:
+            return candidate, encoding
+    return None, None
+
+
+def serve_static(filename):
+    path = _static_path(filename)
+    if path is None:
+        abort(404)
+
+    compressed, encoding = _precompressed(path)
+    if compressed:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        response = send_file(compressed, mimetype=mimetype, conditional=True)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_file(path, conditional=True)
+
+    if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+
+    version = request.args.get('v')
+    if filename.startswith(IMMUTABLE_PREFIXES) or (version and version == asset_version(filename)):
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        response.headers['Cache-Control'] = REVALIDATE
+    return response
+
+
+def compress_static_files(folder, min_size=1024):
+    # Write .gz (and .br when available) next to every compressible file
+    # that is large enough and changed since it was last compressed.
+    written = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            if os.path.getsize(path) < min_size:
+                continue
+
+            mtime = os.path.getmtime(path)
+            for encoding, suffix in ENCODINGS:
+                target = path + suffix
+                if encoding == 'br' and brotli is None:
+                    continue
+                if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if encoding == 'br':
+                    data = brotli.compress(data, quality=11)
+                else:
+                    data = gzip.compress(data, compresslevel=9, mtime=0)
+                with open(target + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(target + '.tmp', target)
+                # Same mtime as the source marks the variant as up to date
+                os.utime(target, (mtime, mtime))
+                written += 1
+    return written
+
+
+def init_assets(app):
+    app.url_defaults(add_static_version)
+    app.view_functions['static'] = serve_static
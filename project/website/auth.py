@@ -1,21 +1,26 @@
-import datetime
+import logging
 import os
 import json
-from flask import Blueprint, current_app, render_template, request, flash, redirect, send_file, url_for, jsonify
-from sqlalchemy import func
-from .models import Game, Student, User, Teacher, FlappyScore  # Added FlappyScore here
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Blueprint, abort, current_app, render_template, request, flash, redirect, send_file, url_for, jsonify
+from .models import Game, Student, User, Teacher
 from werkzeug.utils import secure_filename
 from . import db
+from .leaderboard import get_leaderboard, leaderboard_response
+from .score_queue import InvalidScore, score_queue
+from .counters import download_counter
+from .games import InvalidGameArchive, discard_unpacked, game_file_name, place_game, prepare_game, store_game_file
+from .uploads import stage_upload
+from .blobstore import blob_name, store_staged, release_upload, remove_released
+from .thumbnails import InvalidImage, generate_variants, profile_pic_variants, remove_variants
+from .ordering import apply_order, move_item, next_position
+from .passwords import PasswordHasherBusy, password_hasher
+from .pagination import InvalidCursor, ordered_page
+from .fragments import cached, content_version, render_card
+from sqlalchemy.orm import joinedload
+from markupsafe import Markup
 from flask_login import login_user, logout_user, login_required, current_user
-import zipfile
 
-# ================== GAMES CONFIGURATION ==================
-GAMES_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'games')
-
-# Create games folder if it doesn't exist
-if not os.path.exists(GAMES_FOLDER):
-    os.makedirs(GAMES_FOLDER)
+logger = logging.getLogger(__name__)
 
 auth = Blueprint('auth', __name__)
 
@@ -29,7 +34,15 @@ def login():
         user = User.query.filter_by(email=email).first()
 
         if user:
-            if check_password_hash(user.password, password):
+            if password_hasher.check(user.password, password or ''):
+                if password_hasher.needs_rehash(user.password):
+                    # The hash cost changed; upgrade while we have the password.
+                    # Skipped when the pool is full, the next login retries.
+                    try:
+                        user.password = password_hasher.hash(password)
+                        db.session.commit()
+                    except PasswordHasherBusy:
+                        pass
                 flash('Logged in successfully!', category='success')
                 login_user(user, remember=True)
                 return redirect(url_for('views.home'))
@@ -73,7 +86,7 @@ def sign_up():
             new_user = User(
                 email=email,
                 first_name=first_name,
-                password=generate_password_hash(password1, method='pbkdf2:sha256')
+                password=password_hasher.hash(password1)
             )
             db.session.add(new_user)
             db.session.commit()
@@ -83,12 +96,118 @@ def sign_up():
 
     return render_template("sign_up.html", user=current_user)
 
+@auth.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    # Too many logins at once: answer right away and ask the client to retry
+    flash(e.description, category='error')
+    template = 'sign_up.html' if request.endpoint == 'auth.sign_up' else 'login.html'
+    return render_template(template, user=current_user), 503, {'Retry-After': str(e.retry_after)}
+
+# ---------------- ROSTER PAGING -----------------
+# Student and teacher rosters are shown a page at a time in position order,
+# optionally narrowed to one class section / subject and to names starting
+# with a search prefix. The first page is rendered with the page and the
+# rest are fetched from /api/students and /api/teachers as JSON.
+ROSTER_FILTERS = {Student: 'class_section', Teacher: 'subject'}
+
+def _roster_page(model, cursor=None, group=None, search=None, limit=None):
+    page_size = current_app.config['ROSTER_PAGE_SIZE']
+    limit = max(1, min(limit or page_size, current_app.config['ROSTER_MAX_PAGE_SIZE']))
+
+    query = model.query.options(joinedload(model.user))
+    if group:
+        query = query.filter(getattr(model, ROSTER_FILTERS[model]) == group)
+
+    prefix = (search or '').strip()
+    if prefix:
+        # LIKE 'prefix%' is served by the NOCASE name index. SQLite only folds
+        # ASCII case, so other prefixes are also tried lowercased, uppercased
+        # and capitalised ("élo" finds "Élodie").
+        variants = {prefix} if prefix.isascii() else {
+            prefix, prefix.lower(), prefix.upper(), prefix.capitalize()}
+        query = query.filter(db.or_(*(model.name.like(_like_prefix(variant), escape='\\')
+                                      for variant in sorted(variants))))
+
+    return ordered_page(query, model.position, model.id, cursor=cursor, limit=limit)
+
+def _like_prefix(prefix):
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def _roster_groups(model):
+    column = getattr(model, ROSTER_FILTERS[model])
+    return [value for (value,) in db.session.query(column).distinct().order_by(column)]
+
+def _roster_cards(model, template, name, group, search):
+    # First page of cards for students.html/teachers.html and its next cursor.
+    # Cached whole per viewer (the delete buttons differ) until the table
+    # changes; a miss still reuses the cards of rows that didn't change.
+    def render():
+        rows, next_cursor = _roster_page(model, group=group, search=search)
+        cards = Markup(''.join(render_card(template, name, row, owned=row.user_id == current_user.id)
+                               for row in rows))
+        return cards, next_cursor
+
+    version = content_version(model.__tablename__)
+    return cached('list', (model.__tablename__, version, current_user.id, group, search), render)
+
+def _roster_json(model, rows, next_cursor):
+    group = ROSTER_FILTERS[model]
+    return jsonify({
+        'items': [{
+            'id': person.id,
+            'name': person.name,
+            group: getattr(person, group),
+            'age': person.age,
+            'contact': person.contact,
+            'email': person.email,
+            'added_by': person.user.first_name if person.user else None,
+            'owned': person.user_id == current_user.id,
+            'profile_pic': profile_pic_variants(person.profile_pic) if person.profile_pic else None
+        } for person in rows],
+        'next_cursor': next_cursor
+    })
+
+def _roster_feed(model):
+    try:
+        rows, next_cursor = _roster_page(
+            model,
+            cursor=request.args.get('cursor'),
+            group=request.args.get(ROSTER_FILTERS[model]),
+            search=request.args.get('q'),
+            limit=request.args.get('limit', type=int)
+        )
+    except InvalidCursor:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return _roster_json(model, rows, next_cursor)
+
+def _store_profile_pic(file_storage):
+    # Render the thumbnails from the staged file, then store it. A file
+    # Pillow can't decode is refused before anything is stored, and the
+    # decoding happens before store_staged() takes the database write lock.
+    staged = stage_upload(file_storage)
+    staged.flush()
+    try:
+        generate_variants(blob_name(staged.hexdigest, file_storage.filename), source=staged.path)
+    except InvalidImage:
+        staged.close()
+        raise
+    return store_staged(staged, file_storage.filename)
+
 # ---------------- STUDENT ROUTES -----------------
 @auth.route('/stdu')
 @login_required
 def students_page():
-    students = Student.query.order_by(Student.position.asc()).all()
-    return render_template("students.html", students=students, user=current_user)
+    class_section = request.args.get('class_section', '')
+    search = request.args.get('q', '')
+    cards, next_cursor = _roster_cards(Student, 'student_card.html', 'student', class_section, search)
+    return render_template("students.html", cards=cards, next_cursor=next_cursor,
+                           class_sections=_roster_groups(Student), class_section=class_section,
+                           search=search, user=current_user)
+
+@auth.route('/api/students')
+@login_required
+def students_feed():
+    return _roster_feed(Student)
 
 @auth.route('/add-student', methods=['GET', 'POST'])
 @login_required
@@ -107,12 +226,11 @@ def add_student():
 
         profile_pic_name = None
         if profile_pic and profile_pic.filename != '':
-            profile_pic_name = secure_filename(profile_pic.filename)
-            profile_pic.save(os.path.join(current_app.config['UPLOAD_FOLDER'], profile_pic_name))
-
-        # Get the next position for ordering
-        last_student = Student.query.filter_by(user_id=current_user.id).order_by(Student.position.desc()).first()
-        next_position = last_student.position + 1 if last_student else 0
+            try:
+                profile_pic_name = _store_profile_pic(profile_pic)
+            except InvalidImage:
+                flash('Profile picture must be an image', 'error')
+                return render_template("add_student.html", user=current_user)
 
         new_student = Student(
             name=name,
@@ -122,7 +240,7 @@ def add_student():
             email=email if email else None,
             profile_pic=profile_pic_name,
             user_id=current_user.id,
-            position=next_position
+            position=next_position(Student, current_user.id)
         )
         
         db.session.add(new_student)
@@ -147,19 +265,19 @@ def delete_student():
         if student.user_id != current_user.id:
             return jsonify({'error': 'Not authorized to delete this student'}), 403
         
-        # Delete profile picture if exists
-        if student.profile_pic:
-            profile_pic_path = os.path.join(current_app.config['UPLOAD_FOLDER'], student.profile_pic)
-            if os.path.exists(profile_pic_path):
-                os.remove(profile_pic_path)
+        # Release the profile picture; it is deleted once nothing else uses it
+        released = release_upload(student.profile_pic)
         
         # Delete student from database
         db.session.delete(student)
         db.session.commit()
+        if remove_released(released):
+            remove_variants(student.profile_pic)
         
         return jsonify({'success': True})
         
-    except Exception as e:
+    except Exception:
+        logger.exception('Error in delete_student')
         return jsonify({'error': 'Server error'}), 500
 
 @auth.route('/reorder-students', methods=['POST'])
@@ -167,18 +285,21 @@ def delete_student():
 def reorder_students():
     try:
         data = json.loads(request.data)
-        student_order = data.get('studentOrder', [])
         
-        # Update positions for all students
-        for position, student_id in enumerate(student_order):
-            student = Student.query.get(student_id)
-            if student and student.user_id == current_user.id:
-                student.position = position
+        if 'move' in data:
+            # Single drag: {"move": {"id": X, "index": i}} within your own students
+            updated = move_item(Student, current_user.id, int(data['move']['id']), int(data['move']['index']))
+            if updated is None:
+                return jsonify({'error': 'Student not found'}), 404
+        else:
+            # Full list: positions follow the order of studentOrder
+            updated = apply_order(Student, current_user.id, data.get('studentOrder', []))
         
         db.session.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'updated': updated})
         
-    except Exception as e:
+    except Exception:
+        logger.exception('Error in reorder_students')
         db.session.rollback()
         return jsonify({'error': 'Server error'}), 500
 
@@ -186,8 +307,17 @@ def reorder_students():
 @auth.route('/teacher')
 @login_required
 def teachers_page():
-    teachers = Teacher.query.order_by(Teacher.position.asc()).all()
-    return render_template("teachers.html", teachers=teachers, user=current_user)
+    subject = request.args.get('subject', '')
+    search = request.args.get('q', '')
+    cards, next_cursor = _roster_cards(Teacher, 'teacher_card.html', 'teacher', subject, search)
+    return render_template("teachers.html", cards=cards, next_cursor=next_cursor,
+                           subjects=_roster_groups(Teacher), subject=subject,
+                           search=search, user=current_user)
+
+@auth.route('/api/teachers')
+@login_required
+def teachers_feed():
+    return _roster_feed(Teacher)
 
 @auth.route('/add-teacher', methods=['GET', 'POST'])
 @login_required
@@ -206,12 +336,11 @@ def add_teacher():
 
         profile_pic_name = None
         if profile_pic and profile_pic.filename != '':
-            profile_pic_name = secure_filename(profile_pic.filename)
-            profile_pic.save(os.path.join(current_app.config['UPLOAD_FOLDER'], profile_pic_name))
-
-        # Get the next position for ordering
-        last_teacher = Teacher.query.filter_by(user_id=current_user.id).order_by(Teacher.position.desc()).first()
-        next_position = last_teacher.position + 1 if last_teacher else 0
+            try:
+                profile_pic_name = _store_profile_pic(profile_pic)
+            except InvalidImage:
+                flash('Profile picture must be an image', 'error')
+                return render_template("add_teacher.html", user=current_user)
 
         new_teacher = Teacher(
             name=name,
@@ -221,7 +350,7 @@ def add_teacher():
             email=email if email else None,
             profile_pic=profile_pic_name,
             user_id=current_user.id,
-            position=next_position
+            position=next_position(Teacher, current_user.id)
         )
         
         db.session.add(new_teacher)
@@ -246,19 +375,19 @@ def delete_teacher():
         if teacher.user_id != current_user.id:
             return jsonify({'error': 'Not authorized to delete this teacher'}), 403
         
-        # Delete profile picture if exists
-        if teacher.profile_pic:
-            profile_pic_path = os.path.join(current_app.config['UPLOAD_FOLDER'], teacher.profile_pic)
-            if os.path.exists(profile_pic_path):
-                os.remove(profile_pic_path)
+        # Release the profile picture; it is deleted once nothing else uses it
+        released = release_upload(teacher.profile_pic)
         
         # Delete teacher from database
         db.session.delete(teacher)
         db.session.commit()
+        if remove_released(released):
+            remove_variants(teacher.profile_pic)
         
         return jsonify({'success': True})
         
-    except Exception as e:
+    except Exception:
+        logger.exception('Error in delete_teacher')
         return jsonify({'error': 'Server error'}), 500
 
 @auth.route('/reorder-teachers', methods=['POST'])
@@ -266,18 +395,21 @@ def delete_teacher():
 def reorder_teachers():
     try:
         data = json.loads(request.data)
-        teacher_order = data.get('teacherOrder', [])
         
-        # Update positions for all teachers
-        for position, teacher_id in enumerate(teacher_order):
-            teacher = Teacher.query.get(teacher_id)
-            if teacher and teacher.user_id == current_user.id:
-                teacher.position = position
+        if 'move' in data:
+            # Single drag: {"move": {"id": X, "index": i}} within your own teachers
+            updated = move_item(Teacher, current_user.id, int(data['move']['id']), int(data['move']['index']))
+            if updated is None:
+                return jsonify({'error': 'Teacher not found'}), 404
+        else:
+            # Full list: positions follow the order of teacherOrder
+            updated = apply_order(Teacher, current_user.id, data.get('teacherOrder', []))
         
         db.session.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'updated': updated})
         
-    except Exception as e:
+    except Exception:
+        logger.exception('Error in reorder_teachers')
         db.session.rollback()
         return jsonify({'error': 'Server error'}), 500
 
@@ -296,8 +428,13 @@ def chat_group():
 @auth.route('/games')
 @login_required
 def games_hub():
-    games = Game.query.all()
-    return render_template("games_hub.html", games=games, user=current_user)
+    # The same for every viewer, so one cached list serves everyone
+    def render():
+        games = Game.query.options(joinedload(Game.user)).all()
+        return Markup(''.join(render_card('game_card.html', 'game', game) for game in games)), None
+
+    cards, _ = cached('list', ('game', content_version(Game.__tablename__)), render)
+    return render_template("games_hub.html", cards=cards, user=current_user)
 
 @auth.route('/flappy-bird')
 @login_required
@@ -321,23 +458,42 @@ def upload_game():
             return render_template("upload_game.html", user=current_user)
         
         if game_file and allowed_game_file(game_file.filename):
-            filename = secure_filename(game_file.filename)
-            # FIXED: Use GAMES_FOLDER directly
-            file_path = os.path.join(GAMES_FOLDER, filename)
-            game_file.save(file_path)
+            # Checked where it was staged; nothing reaches GAMES_FOLDER
+            # (created once at startup, see prepare_app) until it passes
+            staged = stage_upload(game_file)
+            staged.flush()
             
             new_game = Game(
                 title=title,
                 description=description,
-                filename=filename,
+                filename=game_file_name(staged.hexdigest, secure_filename(game_file.filename)),
+                file_sha256=staged.hexdigest,
                 file_type=game_type,
                 requirements=requirements,
                 instructions=instructions,
                 user_id=current_user.id
             )
             
-            db.session.add(new_game)
-            db.session.commit()
+            try:
+                # Validate once here and unpack zipped web games, before the
+                # row is added, so no write lock is held while unpacking
+                unpacked = prepare_game(new_game, staged.path)
+            except InvalidGameArchive as e:
+                staged.close()
+                flash(f'Invalid game archive: {e}', 'error')
+                return render_template("upload_game.html", user=current_user)
+            
+            try:
+                db.session.add(new_game)
+                db.session.flush()  # the game's id names its unpacked directory
+                place_game(new_game, unpacked)
+                store_game_file(staged, new_game.filename)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                discard_unpacked(unpacked)
+                staged.close()
+                raise
             flash('Game uploaded successfully! Other students can now play it.', 'success')
             return redirect(url_for('auth.games_hub'))
         else:
@@ -349,19 +505,34 @@ def upload_game():
 @login_required
 def download_game(game_id):
     game = Game.query.get_or_404(game_id)
+    file_path = os.path.join(current_app.config['GAMES_FOLDER'], game.filename)
+    if not os.path.isfile(file_path):
+        logger.error('Missing file for game %s: %s', game.id, game.filename)
+        abort(404)
     
-    # Increment download count
-    game.downloads += 1
-    db.session.commit()
-    
-    # FIXED: Use GAMES_FOLDER directly
-    file_path = os.path.join(GAMES_FOLDER, game.filename)
-    
-    return send_file(
+    # Range requests, If-None-Match/If-Modified-Since (304) and If-Range are
+    # handled by send_file. Games stored under their hash (see games.py) use
+    # it as a strong ETag; older games, stored by name alone, fall back to
+    # one derived from the file's own mtime and size.
+    hashed = game.file_sha256 and game.filename.startswith(game.file_sha256 + '/')
+    response = send_file(
         file_path,
         as_attachment=True,
-        download_name=game.filename
+        download_name=os.path.basename(game.filename),
+        conditional=True,
+        etag=game.file_sha256 if hashed else True
     )
+    # Advertise resumable downloads on the full response too
+    response.accept_ranges = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    # Counted in memory and written in batches. Only a GET that sends the
+    # file from its first byte counts: not HEAD, not a 304 revalidation and
+    # not a resumed transfer (a Range starting later in the file).
+    if request.method == 'GET' and (response.status_code == 200 or (
+            response.status_code == 206 and response.content_range.start == 0)):
+        download_counter.increment(game.id)
+    return response
 
 def allowed_game_file(filename):
     return '.' in filename and \
@@ -385,55 +556,44 @@ def submit_flappy_score():
         player_name = data.get('playerName', current_user.first_name)
         
         # Only save if it's a decent score (optional)
-        if score > 0:
-            new_score = FlappyScore(
-                player_name=player_name,
-                score=score,
-                user_id=current_user.id
-            )
-            db.session.add(new_score)
-            db.session.commit()
+        if score_queue.validate(score) > 0:
+            score_queue.submit(player_name, score, current_user.id)
         
         return jsonify({'success': True})
         
-    except Exception as e:
-        print(f"Error submitting score: {e}")
+    except InvalidScore as e:
+        return jsonify({'error': e.description}), 400
+    except Exception:
+        logger.exception('Error submitting score')
         return jsonify({'error': 'Failed to submit score'}), 500
 
+def _leaderboard_payload():
+    # Get top 10 scores and today's stats
+    leaderboard, stats = get_leaderboard()
+    
+    leaderboard_data = []
+    for score in leaderboard:
+        leaderboard_data.append({
+            'player_name': score.player_name,
+            'score': score.score,
+            'date': score.date_achieved.strftime('%Y-%m-%d')
+        })
+    
+    return {
+        'success': True,
+        'leaderboard': leaderboard_data,
+        'stats': {
+            'players_today': stats['players_today'],
+            'games_played': stats['games_today']
+        }
+    }
+
 @auth.route('/flappy-leaderboard')
 @login_required
 def get_flappy_leaderboard():
     try:
-        # Get top 10 scores
-        leaderboard = FlappyScore.query.order_by(FlappyScore.score.desc()).limit(10).all()
-        
-        # Get today's stats
-        today = datetime.utcnow().date()
-        players_today = db.session.query(FlappyScore.player_name).filter(
-            func.date(FlappyScore.date_achieved) == today
-        ).distinct().count()
-        
-        games_played = FlappyScore.query.filter(
-            func.date(FlappyScore.date_achieved) == today
-        ).count()
-        
-        leaderboard_data = []
-        for score in leaderboard:
-            leaderboard_data.append({
-                'player_name': score.player_name,
-                'score': score.score,
-                'date': score.date_achieved.strftime('%Y-%m-%d')
-            })
-        
-        return jsonify({
-            'success': True,
-            'leaderboard': leaderboard_data,
-            'stats': {
-                'players_today': players_today,
-                'games_played': games_played
-            }
-        })
+        return leaderboard_response('auth', _leaderboard_payload)
         
-    except Exception as e:
-        print(f"Error getting leaderboard: {e}")
+    except Exception:
+        logger.exception('Error getting leaderboard')
         return jsonify({'error': 'Failed to load leaderboard'}), 500
\ No newline at end of file
@@ -0,0 +1,57 @@
+import atexit
+import os
+import threading
+
+# Base for the per-process helpers that hand work to background threads:
+# score_queue, download_counter, extraction_pool, password_hasher and
+# leaderboard_publisher. A subclass sets `name` (its app.extensions key) and
+# `sync_setting`, puts its config defaults in configure() and keeps every
+# lock, buffer and thread in _reset().
+#
+# Process hooks are registered once per instance, however many times
+# create_app() runs: shutdown() at exit, and _reset() in every forked
+# gunicorn worker, which must not inherit the master's locks, buffers or
+# threads (a lock held by a thread that didn't survive the fork would never
+# be released).
+
+
+class BackgroundService:
+    name = None
+    sync_setting = None  # config flag for doing the work inline (always on when TESTING)
+
+    def __init__(self, app=None):
+        self.app = None
+        self._hooks_registered = False
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.sync_setting:
+            app.config.setdefault(self.sync_setting, False)
+        self.configure(app.config)
+        app.extensions[self.name] = self
+        self.app = app
+
+        if not self._hooks_registered:
+            self._hooks_registered = True
+            atexit.register(self.shutdown)
+            os.register_at_fork(after_in_child=self._reset)
+
+    def configure(self, config):
+        pass
+
+    def _reset(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    @property
+    def sync(self):
+        return self.app.config[self.sync_setting] or self.app.testing
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import os
+import shutil
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+from werkzeug.utils import secure_filename
+from . import db
+from .models import Blob, Note, Student, Teacher
+from .uploads import CHUNK_SIZE, stage_upload
+
+logger = logging.getLogger(__name__)
+
+# Uploaded files are stored once per content, at UPLOAD_FOLDER/blobs/ab/<sha256>.<ext>.
+# Note.file_name, Student.profile_pic and Teacher.profile_pic hold that
+# relative name, so templates keep building URLs the same way. A Blob row
+# counts the references; the file is removed only when the last one goes.
+
+BLOB_DIR = 'blobs'
+
+# Model columns that point into UPLOAD_FOLDER
+REFERENCES = [
+    (Note, 'file_name'),
+    (Student, 'profile_pic'),
+    (Teacher, 'profile_pic'),
+]
+
+
+def blob_name(digest, filename):
+    filename = secure_filename(filename or '')
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return f'{BLOB_DIR}/{digest[:2]}/{digest}' + (f'.{ext}' if ext else '')
+
+
+def blob_path(name):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], *name.split('/'))
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_DIR + '/')
+
+
+def _add_reference(name, digest, size, count=1):
+    # Upsert so two requests storing the same new file can't collide
+    db.session.execute(
+        insert(Blob).values(name=name, sha256=digest, size=size, ref_count=count)
+        .on_conflict_do_update(index_elements=['name'],
+                               set_={'ref_count': Blob.ref_count + count})
+    )
+
+
+def store_upload(file_storage):
+    # Store an uploaded file and return the name to save on the model.
+    # Content that is already stored only gains a reference.
+    return store_staged(stage_upload(file_storage), file_storage.filename)
+
+
+def store_staged(staged, filename):
+    # store_upload() for a file already staged (and maybe checked) by the caller
+    name = blob_name(staged.hexdigest, filename)
+    path = blob_path(name)
+
+    # Count the reference before placing the file. The upsert holds the
+    # database write lock until the caller commits, and remove_released()
+    # needs that lock to delete, so it can't unlink the file in between.
+    # The file is always (atomically) replaced rather than trusted to exist,
+    # since a delete may have removed it just before the lock was taken.
+    _add_reference(name, staged.hexdigest, staged.size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    staged.move_to(path)
+    return name
+
+
+def release_upload(name):
+    # Drop one reference to an uploaded file. Returns the path to delete
+    # after the caller commits, or None while other rows still use it.
+    if not name:
+        return None
+    if not is_blob(name):
+        # Stored under its own name before the blob store existed
+        return os.path.join(current_app.config['UPLOAD_FOLDER'], name)
+
+    blob = Blob.query.filter_by(name=name).first()
+    if blob is None or blob.ref_count <= 1:
+        if blob is not None:
+            db.session.delete(blob)
+        return blob_path(name)
+
+    blob.ref_count = Blob.ref_count - 1
+    return None
+
+
+def remove_file(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+
+def remove_released(path):
+    # Delete a file that release_upload() gave up, once the caller has
+    # committed. A blob stays if a Blob row holds it again: an identical
+    # upload may have arrived since. The check runs under the write lock
+    # (see store_upload), so the two can't interleave.
+    if not path:
+        return False
+    folder = current_app.config['UPLOAD_FOLDER']
+    name = '/'.join(os.path.relpath(path, folder).split(os.sep))
+    if not is_blob(name):
+        return remove_file(path)
+
+    try:
+        with db.engine.begin() as conn:
+            # Changes nothing, but takes the write lock
+            conn.execute(update(Blob).where(Blob.name == name).values(ref_count=Blob.ref_count))
+            if conn.execute(select(Blob.name).where(Blob.name == name)).first() is not None:
+                return False
+            return remove_file(path)
+    except OperationalError as e:
+        # Locked for longer than the busy timeout; an unused file is safer
+        # than a missing one (recount-uploads cleans it up)
+        logger.warning('Kept %s, could not check its references: %s', name, e)
+        return False
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def recount_references():
+    # Make every Blob.ref_count match the rows that point at it and delete
+    # blobs nothing references any more. Returns the number of files removed.
+    counts = defaultdict(int)
+    for model, attr in REFERENCES:
+        column = getattr(model, attr)
+        for name, count in db.session.query(column, db.func.count()).filter(
+                column.like(BLOB_DIR + '/%')).group_by(column):
+            counts[name] += count
+
+    removed = []
+    for blob in Blob.query.all():
+        if counts.get(blob.name):
+            blob.ref_count = counts.pop(blob.name)
+        else:
+            db.session.delete(blob)
+            removed.append(blob_path(blob.name))
+
+    # References to files that have no Blob row yet
+    for name, count in counts.items():
+        path = blob_path(name)
+        if os.path.exists(path):
+            digest = name.rsplit('/', 1)[1].split('.', 1)[0]
+            _add_reference(name, digest, os.path.getsize(path), count)
+
+    db.session.commit()
+    return sum(remove_released(path) for path in removed)
+
+
+def migrate_upload_folder(dry_run=False):
+    # Move files stored by their original name into the blob store and
+    # point every reference at the blob. Returns a summary dict.
+    folder = current_app.config['UPLOAD_FOLDER']
+
+    references = defaultdict(list)
+    for model, attr in REFERENCES:
+        column = getattr(model, attr)
+        for row in model.query.filter(column.isnot(None), column != ''):
+            name = getattr(row, attr)
+            if not is_blob(name):
+                references[name].append((row, attr))
+
+    summary = {'migrated': 0, 'duplicates': 0, 'unreferenced': [], 'missing': []}
+    originals = []
+    stored = set()
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        if filename.startswith('.') or not os.path.isfile(path):
+            continue
+        if filename not in references:
+            summary['unreferenced'].append(filename)
+            continue
+
+        name = blob_name(_file_digest(path), filename)
+        destination = blob_path(name)
+        if name in stored or os.path.exists(destination):
+            summary['duplicates'] += 1
+        elif not dry_run:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(path, destination)
+        stored.add(name)
+
+        for row, attr in references.pop(filename):
+            setattr(row, attr, name)
+        originals.append(path)
+        summary['migrated'] += 1
+
+    summary['missing'] = sorted(references)
+
+    if dry_run:
+        db.session.rollback()
+        return summary
+
+    db.session.commit()
+    recount_references()
+    # Only delete the originals once the new references are committed
+    for path in originals:
+        remove_file(path)
+    return summary
@@ -0,0 +1,130 @@
+import click
+from flask import current_app
+
+# Maintenance commands, run with e.g. `flask --app main migrate-uploads`
+# from the project directory.
+
+
+def register_commands(app):
+
+    @app.cli.command('migrate-uploads')
+    @click.option('--dry-run', is_flag=True, help='Report what would change without touching anything.')
+    def migrate_uploads(dry_run):
+        """Move UPLOAD_FOLDER files into the content-addressed blob store."""
+        from .blobstore import migrate_upload_folder
+        summary = migrate_upload_folder(dry_run=dry_run)
+
+        click.echo(f"{'Would migrate' if dry_run else 'Migrated'} {summary['migrated']} files "
+                   f"({summary['duplicates']} duplicates of already stored content)")
+        for filename in summary['unreferenced']:
+            click.echo(f'  left in place, not referenced by any row: {filename}')
+        for filename in summary['missing']:
+            click.echo(f'  referenced but missing on disk: {filename}')
+
+    @app.cli.command('recount-uploads')
+    def recount_uploads():
+        """Recompute blob reference counts and delete unreferenced blobs."""
+        from .blobstore import recount_references
+        removed = recount_references()
+        click.echo(f'Removed {removed} unreferenced files from {current_app.config["UPLOAD_FOLDER"]}')
+
+    @app.cli.command('generate-thumbnails')
+    @click.option('--force', is_flag=True, help='Re-render thumbnails that already exist.')
+    def generate_thumbnails(force):
+        """Create missing profile picture thumbnails for existing students and teachers."""
+        from . import db
+        from .models import Student, Teacher
+        from .thumbnails import Image, InvalidImage, generate_variants
+
+        if Image is None:
+            raise click.ClickException('Pillow is not installed')
+
+        names = set()
+        for model in (Student, Teacher):
+            names.update(name for (name,) in db.session.query(model.profile_pic).filter(
+                model.profile_pic.isnot(None)).distinct())
+
+        written = 0
+        for name in sorted(names):
+            try:
+                written += generate_variants(name, force=force)
+            except InvalidImage as e:
+                click.echo(f'  skipped {name}: {e}')
+        click.echo(f'Wrote {written} thumbnails for {len(names)} profile pictures')
+
+    @app.cli.command('rebalance-positions')
+    def rebalance_positions_command():
+        """Spread student and teacher positions evenly again, keeping their order."""
+        from . import db
+        from .models import Student, Teacher
+        from .ordering import rebalance_positions
+
+        updated = rebalance_positions(Student) + rebalance_positions(Teacher)
+        db.session.commit()
+        click.echo(f'Updated {updated} positions')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Rebuild the full-text note search index from the note table."""
+        from .search import rebuild_search_index
+        rebuild_search_index()
+        click.echo('Rebuilt note search index')
+
+    @app.cli.command('extraction-status')
+    def extraction_status():
+        """Show text extraction progress and the documents that failed."""
+        from . import db
+        from .models import DocumentText
+
+        counts = db.session.query(DocumentText.status, db.func.count()).group_by(DocumentText.status).all()
+        click.echo(', '.join(f'{status}: {count}' for status, count in counts) or 'No documents')
+        for doc in DocumentText.query.filter(DocumentText.status.in_(['failed', 'unsupported'])):
+            click.echo(f'  {doc.status} after {doc.attempts} attempts: {doc.file_name}: {doc.error}')
+
+    @app.cli.command('retry-extractions')
+    def retry_extractions():
+        """Extract text again for every document that failed."""
+        from . import db
+        from .models import DocumentText
+        from .extraction import extraction_pool
+
+        names = [name for (name,) in db.session.query(DocumentText.file_name)
+                 .filter(DocumentText.status == 'failed')]
+        DocumentText.query.filter(DocumentText.file_name.in_(names)).update(
+            {DocumentText.status: 'pending', DocumentText.attempts: 0}, synchronize_session=False)
+        db.session.commit()
+
+        statuses = [extraction_pool.process(name) for name in names]
+        click.echo(f"Retried {len(names)} documents, {statuses.count('done')} extracted")
+
+    @app.cli.command('unpack-games')
+    def unpack_games():
+        """Validate games uploaded before manifests existed and unpack zipped web games."""
+        import os
+        from . import db
+        from .models import Game
+        from .games import InvalidGameArchive, place_game, prepare_game
+
+        folder = current_app.config['GAMES_FOLDER']
+        prepared = 0
+        for game in Game.query.filter(Game.total_size.is_(None)):
+            path = os.path.join(folder, game.filename)
+            if not os.path.exists(path):
+                click.echo(f'  missing file for game {game.id}: {game.filename}')
+                continue
+            try:
+                place_game(game, prepare_game(game, path))
+                prepared += 1
+            except InvalidGameArchive as e:
+                click.echo(f'  game {game.id} ({game.filename}) is not valid: {e}')
+        db.session.commit()
+        click.echo(f'Prepared {prepared} games')
+
+    @app.cli.command('compress-assets')
+    @click.option('--min-size', default=1024, show_default=True, help='Skip files smaller than this many bytes.')
+    def compress_assets(min_size):
+        """Write .gz/.br copies of text files under static/ for precompressed serving."""
+        from .assets import brotli, compress_static_files
+
+        written = compress_static_files(current_app.static_folder, min_size=min_size)
+        click.echo(f'Wrote {written} compressed files' + ('' if brotli else ' (brotli not installed, gzip only)'))
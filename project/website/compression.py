@@ -0,0 +1,108 @@
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is used alone
+    brotli = None
+
+# Compresses dynamic text responses (rendered pages, JSON) with brotli or
+# gzip, whichever the client prefers in Accept-Encoding. Small bodies
+# (under COMPRESS_MIN_SIZE bytes) are sent as is. Streamed responses are
+# compressed chunk by chunk and flushed after each chunk, so nothing is held
+# back. Files from send_file (uploads, games, static assets, which
+# assets.py already serves precompressed) and non-text types are skipped.
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml',
+    'application/json', 'application/javascript', 'text/javascript',
+    'application/xml', 'image/svg+xml',
+}
+COMPRESS_MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # fast enough per request; static assets use 11 ahead of time
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    options = (['br'] if brotli is not None else []) + ['gzip']
+    # Best quality value wins; br is preferred on ties
+    best = max(options, key=lambda encoding: (accepted[encoding], encoding == 'br'))
+    return best if accepted[best] else None
+
+
+class _Compressor:
+    def __init__(self, encoding, app):
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+            self._zlib = None
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self._brotli is not None:
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self):
+        if self._brotli is not None:
+            return self._brotli.flush()
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def _stream(iterable, compressor):
+    for chunk in iterable:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield compressor.compress(chunk) + compressor.flush()
+    yield compressor.finish()
+
+
+def compress_response(response):
+    app = current_app
+    if (not app.config['COMPRESS_ENABLED']
+            or response.direct_passthrough
+            or response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or request.method == 'HEAD'):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    compressor = _Compressor(encoding, app)
+    if response.is_streamed:
+        response.response = _stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the original, so a strong ETag
+    # would be wrong for them
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', GZIP_LEVEL)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', BROTLI_QUALITY)
+    app.after_request(compress_response)
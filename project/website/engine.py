@@ -0,0 +1,80 @@
+import logging
+import os
+from sqlalchemy import event
+from . import db
+
+logger = logging.getLogger(__name__)
+
+# Database engine settings. Every value can be overridden with an environment
+# variable of the same name, e.g. SQLITE_BUSY_TIMEOUT_MS=10000.
+#
+# WAL journaling lets page loads keep reading while a note upload or score
+# flush is writing; synchronous=NORMAL is the usual pairing with WAL (durable
+# across application crashes, only the last commits can be lost on power
+# failure). DB_POOL_SIZE defaults to GUNICORN_THREADS so each worker thread
+# can hold a connection without waiting.
+DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,
+    'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+    'SQLITE_CACHE_SIZE': -20000,  # negative means KiB, so ~20 MB per connection
+    'DB_POOL_SIZE': int(os.environ.get('GUNICORN_THREADS', 5)),
+    'DB_MAX_OVERFLOW': 5,
+    'DB_POOL_TIMEOUT': 10,
+}
+
+PRAGMAS = {
+    'journal_mode': 'SQLITE_JOURNAL_MODE',
+    'synchronous': 'SQLITE_SYNCHRONOUS',
+    'busy_timeout': 'SQLITE_BUSY_TIMEOUT_MS',
+    'mmap_size': 'SQLITE_MMAP_SIZE',
+    'cache_size': 'SQLITE_CACHE_SIZE',
+}
+
+
+def load_engine_config(app):
+    for key, default in DEFAULTS.items():
+        value = os.environ.get(key)
+        if value is None:
+            app.config.setdefault(key, default)
+        else:
+            app.config[key] = type(default)(value)
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+
+    # In-memory SQLite uses a single shared connection, so there is no pool to size
+    if uri not in ('sqlite://', 'sqlite:///:memory:'):
+        options.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', app.config['DB_POOL_TIMEOUT'])
+
+
+def init_engine(app):
+    # Apply the SQLite pragmas to every new connection and report what stuck
+    with app.app_context():
+        engine = db.engine
+        # Connections opened before a fork (gunicorn preload_app) belong to
+        # the parent; forked workers start with an empty pool
+        os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+        if engine.dialect.name != 'sqlite':
+            return
+
+        pragmas = [(name, app.config[key]) for name, key in PRAGMAS.items()]
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+        with engine.connect() as conn:
+            effective = {
+                name: conn.exec_driver_sql(f'PRAGMA {name}').scalar()
+                for name, _ in pragmas
+            }
+        logger.info('SQLite pragmas: %s', ', '.join(f'{k}={v}' for k, v in effective.items()))
+        return effective
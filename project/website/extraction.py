@@ -0,0 +1,290 @@
+import logging
+import queue
+import re
+import threading
+import zipfile
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.sqlite import insert
+from . import db
+from .background import BackgroundService
+from .models import DocumentText, Note
+from .blobstore import blob_path
+
+logger = logging.getLogger(__name__)
+
+# Text is pulled out of uploaded documents by a small pool of background
+# threads, so an upload request only records a pending DocumentText row and
+# returns. EXTRACTION_WORKERS threads take file names from a local queue;
+# the text is stored on DocumentText (one row per stored file) and copied to
+# Note.file_text of every note attaching that file, which the search index
+# picks up.
+#
+# A failed extraction is retried after EXTRACTION_RETRY_SECONDS, doubling
+# each time, until EXTRACTION_MAX_ATTEMPTS; the row keeps the last error and
+# `flask extraction-status` lists failures. Rows still pending when the
+# process stopped are queued again by each process on its first request, so
+# a preloaded gunicorn master never starts extraction threads before forking.
+# Every worker queues them, but a document is claimed (pending -> running)
+# with a conditional UPDATE before it is parsed, so only one worker does the
+# work. A claim older than EXTRACTION_CLAIM_SECONDS (its worker died) can be
+# taken again.
+# With EXTRACTION_SYNC (on automatically when TESTING) documents are
+# extracted inside the request instead.
+
+EXTRACTABLE_EXTENSIONS = {'pdf', 'docx', 'txt'}
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+class UnsupportedDocument(Exception):
+    # Extraction can't work for this file; not retried
+    pass
+
+
+def _extension(file_name):
+    return file_name.rsplit('.', 1)[1].lower() if file_name and '.' in file_name else ''
+
+
+def is_extractable(file_name):
+    return _extension(file_name) in EXTRACTABLE_EXTENSIONS
+
+
+def _docx_text(path, max_chars):
+    parts = []
+    size = 0
+    with zipfile.ZipFile(path) as archive:
+        try:
+            document = archive.open('word/document.xml')
+        except KeyError:
+            raise UnsupportedDocument('not a Word document (no word/document.xml)')
+        with document:
+            for _, element in ElementTree.iterparse(document):
+                if element.tag == WORD_NS + 't' and element.text:
+                    parts.append(element.text)
+                    size += len(element.text)
+                elif element.tag == WORD_NS + 'tab':
+                    parts.append('\t')
+                elif element.tag in (WORD_NS + 'br', WORD_NS + 'p'):
+                    parts.append('\n')
+                    element.clear()
+                if size > max_chars:
+                    break
+    return ''.join(parts)
+
+
+def _pdf_text(path, max_chars):
+    # pypdf is optional (PDFs are then marked unsupported) and slow to
+    # import, so it is loaded on the first PDF rather than at startup
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedDocument('pypdf is not installed')
+    parts = []
+    size = 0
+    for page in PdfReader(path).pages:
+        text = page.extract_text() or ''
+        parts.append(text)
+        size += len(text)
+        if size > max_chars:
+            break
+    return '\n'.join(parts)
+
+
+def _txt_text(path, max_chars):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return f.read(max_chars)
+
+
+EXTRACTORS = {'docx': _docx_text, 'pdf': _pdf_text, 'txt': _txt_text}
+
+
+def extract_text(path, file_name, max_chars):
+    text = EXTRACTORS[_extension(file_name)](path, max_chars)
+    # Collapse runs of spaces and blank lines left by layout
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+    text = re.sub(r' ?\n ?', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()[:max_chars]
+
+
+def attach_document(note):
+    # Call while adding a note with an attachment, before committing.
+    # Copies already extracted text onto the note; returns True if the file
+    # is new and should be passed to extraction_pool.submit() after commit.
+    if not is_extractable(note.file_name):
+        return False
+
+    doc = DocumentText.query.filter_by(file_name=note.file_name).first()
+    if doc is not None:
+        if doc.status == 'done':
+            note.file_text = doc.text
+        return False
+
+    # Upsert so two requests storing the same new file can't collide
+    db.session.execute(
+        insert(DocumentText).values(file_name=note.file_name, status='pending')
+        .on_conflict_do_nothing(index_elements=['file_name'])
+    )
+    return True
+
+
+def forget_document(file_name):
+    # The stored file is going away; drop its extracted text too
+    if file_name:
+        DocumentText.query.filter_by(file_name=file_name).delete(synchronize_session=False)
+
+
+class ExtractionPool(BackgroundService):
+    name = 'extraction_pool'
+    sync_setting = 'EXTRACTION_SYNC'
+
+    def configure(self, config):
+        config.setdefault('EXTRACTION_WORKERS', 2)
+        config.setdefault('EXTRACTION_MAX_ATTEMPTS', 3)
+        config.setdefault('EXTRACTION_RETRY_SECONDS', 30)
+        config.setdefault('EXTRACTION_CLAIM_SECONDS', 600)
+        config.setdefault('EXTRACTION_MAX_CHARS', 200000)
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.before_request(self._resume_once)
+
+    def _reset(self):
+        self._resumed = False
+        self._queue = queue.Queue()
+        self._threads = []
+        self._timers = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def submit(self, file_name):
+        # Queue a document for extraction; call after its note is committed
+        if not is_extractable(file_name):
+            return
+        if self.sync:
+            self.process(file_name)
+            return
+        self._ensure_threads()
+        self._queue.put(file_name)
+
+    def _claimable(self):
+        # Pending, or claimed by a worker that has been silent too long
+        stale = datetime.utcnow() - timedelta(seconds=self.app.config['EXTRACTION_CLAIM_SECONDS'])
+        return or_(DocumentText.status == 'pending',
+                   and_(DocumentText.status == 'running', DocumentText.updated_at < stale))
+
+    def resume(self):
+        # Queue every document left pending, e.g. by a restart
+        with self.app.app_context():
+            names = [name for (name,) in db.session.query(DocumentText.file_name)
+                     .filter(self._claimable())]
+        for name in names:
+            self.submit(name)
+        return len(names)
+
+    def _resume_once(self):
+        if self._resumed:
+            return
+        with self._lock:
+            if self._resumed:
+                return
+            self._resumed = True
+        self.resume()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def shutdown(self):
+        self._stopping = True
+        with self._lock:
+            for timer in self._timers:
+                timer.cancel()
+            self._timers.clear()
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _ensure_threads(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.app.config['EXTRACTION_WORKERS']:
+                self._threads.append(self._start_thread(self._run, f'extraction-{len(self._threads)}'))
+
+    def _run(self):
+        while not self._stopping:
+            file_name = self._queue.get()
+            if file_name is None:
+                break
+            with self.app.app_context():
+                try:
+                    self.process(file_name)
+                except Exception:
+                    logger.exception('Error extracting text from %s', file_name)
+                finally:
+                    db.session.remove()
+
+    def _retry_later(self, file_name, delay):
+        def requeue():
+            with self._lock:
+                self._timers.discard(timer)
+            if not self._stopping:
+                self.submit(file_name)
+
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        with self._lock:
+            self._timers.add(timer)
+        timer.start()
+
+    def process(self, file_name):
+        # Extract one document and record the outcome. Returns the status.
+        # The claim commits at once, so no transaction is held open while
+        # the file is parsed.
+        claimed = DocumentText.query.filter(DocumentText.file_name == file_name, self._claimable()).update(
+            {DocumentText.status: 'running', DocumentText.updated_at: datetime.utcnow()},
+            synchronize_session=False)
+        doc = DocumentText.query.filter_by(file_name=file_name).first()
+        db.session.commit()
+        if not claimed:
+            return doc.status if doc else None  # done, or another worker has it
+
+        config = self.app.config
+        retry = False
+        text = None
+        try:
+            text = extract_text(blob_path(file_name), file_name, config['EXTRACTION_MAX_CHARS'])
+            status, error = 'done', None
+        except UnsupportedDocument as e:
+            status, error = 'unsupported', str(e)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'[:500]
+            retry = doc.attempts + 1 < config['EXTRACTION_MAX_ATTEMPTS']
+            status = 'pending' if retry else 'failed'
+
+        doc = DocumentText.query.filter_by(file_name=file_name).first()
+        if doc is None:
+            return None  # the file was deleted meanwhile
+        doc.attempts += 1
+        doc.status = status
+        doc.error = error
+        doc.updated_at = datetime.utcnow()
+        if status == 'done':
+            doc.text = text
+            Note.query.filter_by(file_name=file_name).update(
+                {Note.file_text: text}, synchronize_session=False
+            )
+        db.session.commit()
+
+        if status == 'done':
+            logger.info('Extracted %d characters from %s', len(text), file_name)
+        else:
+            logger.warning('Text extraction %s for %s (attempt %d): %s', status, file_name, doc.attempts, error)
+        if retry:
+            if self.sync:
+                return self.process(file_name)
+            self._retry_later(file_name, config['EXTRACTION_RETRY_SECONDS'] * 2 ** (doc.attempts - 1))
+        return status
+
+
+extraction_pool = ExtractionPool()
@@ -0,0 +1,168 @@
+import os
+import threading
+from collections import OrderedDict
+from flask import current_app, render_template
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from . import db
+from .metrics import registry
+from .models import CacheVersion, Game, Student, Teacher
+
+# Rendered-HTML cache for the roster pages and the games hub.
+#
+# Two levels, both in one LRU per process bounded by FRAGMENT_CACHE_MAX_BYTES
+# of HTML (least recently used entries are dropped first):
+#
+# - row: one card, keyed by the row's own column values (and whether the
+#   viewer owns it), so an edited row simply misses. Position is left out,
+#   so reordering reuses every card.
+# - list: the whole first page of cards for one filter/search, keyed by the
+#   content version of its table (CacheVersion). A hit skips the roster
+#   query entirely.
+#
+# Every write to students, teachers or games bumps that table's version in
+# the same transaction: ORM flushes (add/delete/edit) through before_flush,
+# bulk UPDATE/DELETE statements (reordering, download counts) through
+# do_orm_execute. Because the version lives in the database, a write handled
+# by one gunicorn worker invalidates the lists cached by all of them.
+#
+# Set FRAGMENT_CACHE_ENABLED to False to render everything on each request.
+
+FRAGMENT_HITS = registry.counter(
+    'fragment_cache_hits_total', 'Rendered fragments served from the cache.', ('kind',))
+FRAGMENT_MISSES = registry.counter(
+    'fragment_cache_misses_total', 'Fragments rendered because they were not cached.', ('kind',))
+
+# Tables whose content the cached fragments show; each has a CacheVersion row
+VERSIONED = {Student.__tablename__, Teacher.__tablename__, Game.__tablename__}
+
+
+class FragmentCache:
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._size = 0
+
+    def size(self):
+        return self._size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+fragment_cache = FragmentCache()
+
+
+def _enabled():
+    return current_app.config['FRAGMENT_CACHE_ENABLED']
+
+
+def content_version(name):
+    # Read before querying the rows, so a write in between can only make
+    # the cached list fresher than its key, never older
+    version = db.session.get(CacheVersion, name)
+    return version.version if version is not None else 0
+
+
+def bump_version(session, name):
+    session.execute(
+        insert(CacheVersion).values(name=name, version=1)
+        .on_conflict_do_update(index_elements=['name'],
+                               set_={'version': CacheVersion.version + 1})
+    )
+
+
+def row_version(obj):
+    # The loaded column values of a row (but not its position) and the
+    # name of the user who added it: everything a card shows
+    state = inspect(obj)
+    values = tuple(state.dict.get(attr.key) for attr in state.mapper.column_attrs
+                   if attr.key != 'position' and not attr.deferred)
+    user = state.dict.get('user')
+    return values + (user.first_name if user is not None else None,)
+
+
+def cached(kind, key, render):
+    # render() returns (html, extra); both are cached together
+    if not _enabled():
+        return render()
+    key = (kind,) + key
+    value = fragment_cache.get(key)
+    if value is not None:
+        FRAGMENT_HITS.inc(kind=kind)
+        return value
+    FRAGMENT_MISSES.inc(kind=kind)
+    value = render()
+    fragment_cache.set(key, value, len(value[0]))
+    return value
+
+
+def render_card(template, name, obj, owned=None):
+    # One row's card, from the row cache when its content hasn't changed
+    key = (obj.__tablename__, obj.id, owned, row_version(obj))
+    html, _ = cached('row', key, lambda: (
+        Markup(render_template(template, **{name: obj, 'owned': owned})), None))
+    return html
+
+
+def _changed_tables(objects):
+    return {obj.__tablename__ for obj in objects
+            if getattr(obj, '__tablename__', None) in VERSIONED}
+
+
+def _bump_on_flush(session, flush_context, instances):
+    changed = _changed_tables(session.new) | _changed_tables(session.deleted)
+    changed |= _changed_tables(obj for obj in session.dirty if session.is_modified(obj))
+    for name in sorted(changed):
+        bump_version(session, name)
+
+
+def _bump_on_bulk_write(state):
+    # Bulk UPDATE/DELETE statements skip the flush (reordering, download counts)
+    if state.is_update or state.is_delete:
+        name = getattr(state.statement.table, 'name', None)
+        if name in VERSIONED:
+            bump_version(state.session, name)
+
+
+def init_fragments(app):
+    app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+    app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', int(os.environ.get(
+        'FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)))
+    fragment_cache.max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+    registry.gauge('fragment_cache_bytes', 'HTML held in the fragment cache.', fragment_cache.size)
+
+    if not event.contains(Session, 'before_flush', _bump_on_flush):
+        event.listen(Session, 'before_flush', _bump_on_flush)
+        event.listen(Session, 'do_orm_execute', _bump_on_bulk_write)
+        # Forked workers start with an empty cache and a fresh lock
+        os.register_at_fork(after_in_child=fragment_cache._reset)
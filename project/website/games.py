@@ -0,0 +1,200 @@
+import os
+import shutil
+import stat
+import tempfile
+import zipfile
+from flask import current_app
+
+# Uploaded games are processed once, when they are uploaded. A .zip archive
+# is checked entry by entry (no absolute or parent paths, no symlinks, no
+# encryption, bounded file count, unpacked size and compression ratio).
+# Web games are then unpacked into GAMES_FOLDER/<game id>/ so games_hub can
+# link straight to their entry page. Every game gets a manifest on its row:
+# entry_point (relative to GAMES_FOLDER), total_size and the file list.
+#
+# All of that happens before the game's row is added: the archive is
+# unpacked into a staging directory, and place_game() only renames it once
+# the row has an id. No database write lock is held while unpacking.
+#
+# The uploaded file is validated where it was staged and only then stored,
+# as GAMES_FOLDER/<sha256>/<name>. Its path names its content, so a later
+# upload with the same name can never overwrite (or delete) another game's
+# file, and the stored hash is always the hash of the bytes served.
+
+MB = 1024 * 1024
+
+GAME_MAX_FILES = 500
+GAME_MAX_UNPACKED_SIZE = 100 * MB
+GAME_MAX_RATIO = 100  # unpacked / compressed, per entry
+CHUNK_SIZE = 64 * 1024
+
+WEB_ENTRY_NAMES = ('index.html', 'index.htm')
+DESKTOP_ENTRY_NAMES = ('main.py', 'game.py', '__main__.py')
+
+
+class InvalidGameArchive(ValueError):
+    pass
+
+
+def _is_symlink(info):
+    return stat.S_ISLNK(info.external_attr >> 16)
+
+
+def _safe_name(name):
+    # Normalized relative path inside the game directory, or None
+    name = name.replace('\\', '/')
+    if name.startswith('/') or (len(name) > 1 and name[1] == ':'):
+        return None
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return '/'.join(parts)
+
+
+def _pick_entry(paths, names, extension):
+    # Shallowest file with a preferred name, else the only file of that type
+    candidates = sorted((path for path in paths if path.rsplit('/', 1)[-1].lower() in names),
+                        key=lambda path: (path.count('/'), path))
+    if candidates:
+        return candidates[0]
+    typed = [path for path in paths if path.lower().endswith(extension)]
+    return typed[0] if len(typed) == 1 else None
+
+
+def inspect_archive(path):
+    # Validate a game archive without unpacking it. Returns the manifest
+    # (entry point still relative to the archive root).
+    config = current_app.config
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        raise InvalidGameArchive('not a valid .zip file')
+
+    files = []
+    total = 0
+    with archive:
+        entries = archive.infolist()
+        if len(entries) > config['GAME_MAX_FILES']:
+            raise InvalidGameArchive(f"more than {config['GAME_MAX_FILES']} files")
+
+        for info in entries:
+            name = _safe_name(info.filename)
+            if name is None:
+                raise InvalidGameArchive(f'unsafe path {info.filename!r}')
+            if info.is_dir():
+                continue
+            if _is_symlink(info):
+                raise InvalidGameArchive(f'{name} is a symbolic link')
+            if info.flag_bits & 0x1:
+                raise InvalidGameArchive(f'{name} is encrypted')
+            if info.file_size > GAME_MAX_RATIO * max(info.compress_size, 1) and info.file_size > MB:
+                raise InvalidGameArchive(f'{name} is compressed suspiciously well')
+
+            total += info.file_size
+            if total > config['GAME_MAX_UNPACKED_SIZE']:
+                raise InvalidGameArchive(f"unpacks to more than {config['GAME_MAX_UNPACKED_SIZE'] // MB} MB")
+            files.append({'path': name, 'size': info.file_size})
+
+    if not files:
+        raise InvalidGameArchive('the archive is empty')
+    if len({f['path'] for f in files}) != len(files):
+        raise InvalidGameArchive('the archive lists the same file twice')
+    return {'files': files, 'total_size': total}
+
+
+def game_file_name(digest, filename):
+    # Where an uploaded game is stored, relative to GAMES_FOLDER
+    return f'{digest}/{filename}'
+
+
+def store_game_file(staged, name):
+    # Move a validated StreamedUpload to GAMES_FOLDER/name. The same name
+    # means the same bytes, so an existing copy is kept as it is.
+    path = os.path.join(current_app.config['GAMES_FOLDER'], *name.split('/'))
+    if os.path.exists(path):
+        staged.close()
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staged.move_to(path)
+    return path
+
+
+def _unpack(path, manifest):
+    # Unpack into a staging directory in GAMES_FOLDER and return it, so a
+    # half-written game is never served. Sizes are enforced on the bytes
+    # actually written, not just the archive's headers.
+    staging = tempfile.mkdtemp(prefix='.unpack-', dir=current_app.config['GAMES_FOLDER'])
+    sizes = {f['path']: f['size'] for f in manifest['files']}
+    try:
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                name = _safe_name(info.filename)
+                if info.is_dir() or name not in sizes:
+                    continue
+                target = os.path.join(staging, *name.split('/'))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                written = 0
+                with archive.open(info) as source, open(target, 'wb') as out:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        written += len(chunk)
+                        if written > sizes[name]:
+                            raise InvalidGameArchive(f'{name} is larger than the archive says')
+                        out.write(chunk)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return staging
+
+
+def prepare_game(game, path):
+    # Validate the file at `path` (the staged upload, or the stored copy for
+    # older games) and fill in the game's manifest. Zipped web games are
+    # unpacked into a staging directory, which is returned for place_game();
+    # otherwise returns None. Raises InvalidGameArchive.
+    filename = game.filename
+
+    if not filename.lower().endswith('.zip'):
+        game.total_size = os.path.getsize(path)
+        game.manifest = {'files': [{'path': filename.rsplit('/', 1)[-1], 'size': game.total_size}]}
+        game.entry_point = filename if filename.lower().endswith(('.html', '.htm', '.py')) else None
+        return None
+
+    manifest = inspect_archive(path)
+    paths = [f['path'] for f in manifest['files']]
+
+    unpacked = None
+    if game.file_type == 'web':
+        entry = _pick_entry(paths, WEB_ENTRY_NAMES, '.html')
+        if entry is None:
+            raise InvalidGameArchive('web games need an index.html')
+        unpacked = _unpack(path, manifest)
+        game.entry_point = entry  # made relative to GAMES_FOLDER by place_game()
+    else:
+        entry = _pick_entry(paths, DESKTOP_ENTRY_NAMES, '.py')
+        game.entry_point = entry  # shown to players; the archive is downloaded whole
+
+    game.total_size = manifest['total_size']
+    game.manifest = {'files': manifest['files']}
+    return unpacked
+
+
+def place_game(game, unpacked):
+    # Move what prepare_game() unpacked to GAMES_FOLDER/<game id>; the game
+    # must have its id (be flushed) by now
+    if unpacked is None:
+        return
+    destination = os.path.join(current_app.config['GAMES_FOLDER'], str(game.id))
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    os.replace(unpacked, destination)
+    game.entry_point = f'{game.id}/{game.entry_point}'
+
+
+def discard_unpacked(unpacked):
+    if unpacked is not None:
+        shutil.rmtree(unpacked, ignore_errors=True)
+
+
+def init_games(app):
+    app.config.setdefault('GAME_MAX_FILES', GAME_MAX_FILES)
+    app.config.setdefault('GAME_MAX_UNPACKED_SIZE', GAME_MAX_UNPACKED_SIZE)
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from . import db
+from .models import User
+
+# Short-lived cache for the Flask-Login user loader. Every authenticated
+# request loads current_user; within USER_CACHE_TTL seconds of the last load
+# the user is rebuilt from cached columns and attached to the session without
+# a SELECT. The password hash is never cached: it is loaded on access.
+#
+# At most USER_CACHE_MAX_ENTRIES users are held (least recently loaded go
+# first), and a user is dropped as soon as their row is updated or deleted.
+
+CACHED_COLUMNS = ('id', 'email', 'first_name')
+
+# user id -> (expires_at, column values), oldest first
+_users = OrderedDict()
+_lock = threading.Lock()
+
+
+def load_cached_user(user_id):
+    now = time.monotonic()
+    with _lock:
+        entry = _users.get(user_id)
+        if entry and entry[0] > now:
+            _users.move_to_end(user_id)
+        else:
+            entry = None
+    if entry:
+        user = User(**entry[1])
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        forget_user(user_id)
+        return None
+
+    ttl = current_app.config['USER_CACHE_TTL']
+    if ttl > 0:
+        with _lock:
+            _users[user_id] = (now + ttl, {name: getattr(user, name) for name in CACHED_COLUMNS})
+            _users.move_to_end(user_id)
+            while len(_users) > current_app.config['USER_CACHE_MAX_ENTRIES']:
+                _users.popitem(last=False)
+    return user
+
+
+def forget_user(user_id):
+    with _lock:
+        _users.pop(user_id, None)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_changed_user(mapper, connection, target):
+    forget_user(target.id)
@@ -0,0 +1,209 @@
+import atexit
+import hmac
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from flask import Response, abort, before_render_template, current_app, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from . import db
+from .metrics import COUNT_BUCKETS, SIZE_BUCKETS, registry
+
+# Request-level instrumentation.
+#
+# Per-request SQL query counter: every statement run while handling a request
+# is counted (and timed) on flask.g. With QUERY_COUNT_HEADER enabled (always
+# on in debug mode) responses carry X-Query-Count and X-Query-Time-Ms, which
+# makes N+1 query regressions visible from the browser's network tab.
+#
+# The same numbers, plus request latency per endpoint, template render time
+# and upload sizes, are collected into metrics.registry and served at
+# /metrics in the Prometheus text format to requests with
+# "Authorization: Bearer <METRICS_TOKEN>". Without METRICS_TOKEN the page is
+# only served in debug mode.
+#
+# Logging: the 'website' loggers write through a queue to a background
+# thread, so a request never blocks on stdout. LOG_LEVEL sets the level.
+#
+# StartupTimer times the phases of create_app(); the total is logged and
+# reported as app_startup_seconds.
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+REQUEST_LATENCY = registry.histogram(
+    'http_request_duration_seconds', 'Time spent handling a request, by endpoint.',
+    ('endpoint', 'method'))
+REQUESTS = registry.counter(
+    'http_requests_total', 'Requests handled, by endpoint and status.',
+    ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = registry.histogram(
+    'http_request_db_queries', 'SQL statements run per request, by endpoint.',
+    ('endpoint',), COUNT_BUCKETS)
+QUERY_LATENCY = registry.histogram(
+    'db_query_duration_seconds', 'Time per SQL statement, by endpoint (background for work outside requests).',
+    ('endpoint',))
+TEMPLATE_LATENCY = registry.histogram(
+    'template_render_duration_seconds', 'Time spent rendering a template.', ('template',))
+UPLOAD_BYTES = registry.counter(
+    'upload_bytes_total', 'Bytes received in uploaded files, by extension.', ('extension',))
+UPLOAD_SIZE = registry.histogram(
+    'upload_size_bytes', 'Size of uploaded files, by extension.', ('extension',), SIZE_BUCKETS)
+
+_log_handler = None
+_log_listener = None
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.phases = []
+        self.total = None
+
+    def mark(self, phase):
+        # Record the time since the previous mark under `phase`
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        self.total = time.perf_counter() - self.started
+        logger.info('App ready in %.0f ms (%s)', self.total * 1000,
+                    ', '.join(f'{phase} {seconds * 1000:.0f} ms' for phase, seconds in self.phases))
+        return self.total
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def record_upload(filename, size):
+    # Called by uploads.stage_upload for every file an upload route takes.
+    # Extensions come from the client, so unknown ones share one series.
+    extension = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+    if extension not in current_app.config['UPLOAD_SIZE_LIMITS']:
+        extension = 'other'
+    UPLOAD_BYTES.inc(size, extension=extension)
+    UPLOAD_SIZE.observe(size, extension=extension)
+
+
+def _start_log_listener():
+    # A fresh queue each time: after a fork the parent's listener may have
+    # been holding the old queue's lock
+    global _log_listener
+    _log_handler.queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _log_listener = QueueListener(_log_handler.queue, handler, respect_handler_level=True)
+    _log_listener.start()
+
+
+def _stop_log_listener():
+    if _log_listener is not None and _log_listener._thread is not None:
+        _log_listener.stop()
+
+
+def init_logging(app):
+    global _log_handler
+    root = logging.getLogger('website')
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    if _log_handler is not None:
+        return  # create_app() called again in the same process
+    _log_handler = QueueHandler(queue.SimpleQueue())
+    root.addHandler(_log_handler)
+    root.propagate = False
+    _start_log_listener()
+    atexit.register(_stop_log_listener)
+    # The listener thread doesn't survive a fork; forked workers start their own
+    os.register_at_fork(after_in_child=_start_log_listener)
+
+
+def init_query_counter(app):
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+            g.query_time = g.get('query_time', 0.0) + elapsed
+            QUERY_LATENCY.observe(elapsed, endpoint=_endpoint())
+        else:
+            QUERY_LATENCY.observe(elapsed, endpoint='background')
+
+    @app.after_request
+    def add_query_count_header(response):
+        if app.debug or app.config['QUERY_COUNT_HEADER']:
+            response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+            response.headers['X-Query-Time-Ms'] = f"{g.get('query_time', 0.0) * 1000:.1f}"
+        return response
+
+
+def init_metrics(app):
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is not None:
+            endpoint = _endpoint()
+            REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+            REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+            REQUEST_QUERIES.observe(g.get('query_count', 0), endpoint=endpoint)
+        return response
+
+    def start_template_timer(sender, template, context, **extra):
+        if has_request_context():
+            g.setdefault('template_starts', []).append(time.perf_counter())
+
+    def record_template(sender, template, context, **extra):
+        if has_request_context() and g.get('template_starts'):
+            TEMPLATE_LATENCY.observe(time.perf_counter() - g.template_starts.pop(),
+                                     template=template.name or 'string')
+
+    # Held strongly; blinker would otherwise drop these local functions
+    before_render_template.connect(start_template_timer, app, weak=False)
+    template_rendered.connect(record_template, app, weak=False)
+
+    # Work waiting in the background queues
+    from .counters import download_counter
+    from .extraction import extraction_pool
+    from .leaderboard_stream import leaderboard_publisher
+    from .passwords import password_hasher
+    from .score_queue import score_queue
+    registry.gauge('score_queue_pending', 'Scores waiting to be written.', score_queue.pending)
+    registry.gauge('download_counts_pending', 'Game downloads counted but not yet written.',
+                   download_counter.pending)
+    registry.gauge('extraction_queue_pending', 'Documents waiting for text extraction.',
+                   extraction_pool.pending)
+    startup = app.extensions.get('startup_timer')
+    if startup is not None:
+        registry.gauge('app_startup_seconds', 'Time create_app() took in this process.',
+                       lambda: startup.total or 0.0)
+    registry.gauge('leaderboard_stream_clients', 'Open live leaderboard streams.',
+                   leaderboard_publisher.clients)
+    registry.gauge('password_hash_pending', 'Password hashes running or waiting for a worker.',
+                   password_hasher.pending)
+
+    def metrics():
+        token = app.config['METRICS_TOKEN']
+        if not token:
+            if not app.debug:
+                abort(404)
+        elif not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
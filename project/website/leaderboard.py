@@ -0,0 +1,194 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime
+from flask import current_app, request
+from . import db
+from .models import FlappyScore, FlappyBest, FlappyStats
+
+# The Flappy Bird leaderboard is read from FlappyBest (one row per player) and
+# FlappyStats (a single counters row). Both are kept up to date as scores come
+# in, so reading the leaderboard never has to scan the FlappyScore history.
+
+STATS_ID = 1
+
+# Serialized leaderboard responses, shared by every request in this process.
+# An entry is rebuilt when its TTL runs out or when a new score bumps the
+# version, so other gunicorn workers pick up changes within one TTL.
+_cache = {}
+_version = 0
+_lock = threading.Lock()
+
+
+def _get_stats():
+    stats = db.session.get(FlappyStats, STATS_ID)
+    if stats is None:
+        stats = FlappyStats(id=STATS_ID, games_played=0, total_players=0,
+                            players_today=0, games_today=0)
+        db.session.add(stats)
+        db.session.flush()
+    return stats
+
+
+def record_score(player_name, score, user_id, achieved_at=None):
+    # Update the best-score row and counters for one finished game.
+    # The caller is responsible for committing the session.
+    achieved_at = achieved_at or datetime.utcnow()
+    today = achieved_at.date()
+
+    stats = _get_stats()
+    if stats.stats_day is None or today > stats.stats_day:
+        stats.stats_day = today
+        stats.players_today = 0
+        stats.games_today = 0
+        db.session.flush()
+    # A score from an earlier day (a retried write from before midnight)
+    # only counts toward the totals
+    counts_today = today == stats.stats_day
+
+    best = FlappyBest.query.filter_by(player_name=player_name).first()
+    if best is None:
+        db.session.add(FlappyBest(
+            player_name=player_name,
+            score=score,
+            user_id=user_id,
+            date_achieved=achieved_at,
+            last_played=achieved_at
+        ))
+        stats.total_players = FlappyStats.total_players + 1
+        if counts_today:
+            stats.players_today = FlappyStats.players_today + 1
+    else:
+        if counts_today and (best.last_played is None or best.last_played.date() < today):
+            stats.players_today = FlappyStats.players_today + 1
+        if score > best.score:
+            best.score = score
+            best.user_id = user_id
+            best.date_achieved = achieved_at
+        if best.last_played is None or achieved_at > best.last_played:
+            best.last_played = achieved_at
+
+    # Increment in SQL so concurrent workers don't lose updates
+    stats.games_played = FlappyStats.games_played + 1
+    if counts_today:
+        stats.games_today = FlappyStats.games_today + 1
+    db.session.flush()
+
+
+def get_leaderboard(limit=10):
+    top = FlappyBest.query.order_by(FlappyBest.score.desc()).limit(limit).all()
+    stats = db.session.get(FlappyStats, STATS_ID)
+
+    today = datetime.utcnow().date()
+    counters = {'players_today': 0, 'games_today': 0, 'games_played': 0, 'total_players': 0}
+    if stats is not None:
+        counters['games_played'] = stats.games_played
+        counters['total_players'] = stats.total_players
+        if stats.stats_day == today:
+            counters['players_today'] = stats.players_today
+            counters['games_today'] = stats.games_today
+
+    return top, counters
+
+
+def leaderboard_payload(limit=10):
+    # Top scores and counters as sent to the game page (JSON and stream)
+    top, stats = get_leaderboard(limit)
+    return {
+        'leaderboard': [{
+            'player_name': best.player_name,
+            'score': best.score,
+            'date_achieved': best.date_achieved.isoformat()
+        } for best in top],
+        'stats': {
+            'players_today': stats['players_today'],
+            'games_played': stats['games_played'],
+            'total_players': stats['total_players']
+        }
+    }
+
+
+def rebuild_leaderboard():
+    # Populate FlappyBest/FlappyStats from the FlappyScore history.
+    # Runs once for databases created before the summary tables existed.
+    if db.session.get(FlappyStats, STATS_ID) is not None:
+        return
+
+    FlappyBest.query.delete()
+
+    best_scores = db.session.query(
+        FlappyScore.player_name,
+        db.func.max(FlappyScore.score).label('max_score'),
+        db.func.max(FlappyScore.date_achieved).label('last_played')
+    ).group_by(FlappyScore.player_name).subquery()
+
+    rows = db.session.query(
+        FlappyScore.player_name,
+        FlappyScore.score,
+        FlappyScore.user_id,
+        db.func.min(FlappyScore.date_achieved),
+        best_scores.c.last_played
+    ).join(
+        best_scores,
+        db.and_(
+            FlappyScore.player_name == best_scores.c.player_name,
+            FlappyScore.score == best_scores.c.max_score
+        )
+    ).group_by(FlappyScore.player_name).all()
+
+    for player_name, score, user_id, date_achieved, last_played in rows:
+        db.session.add(FlappyBest(
+            player_name=player_name,
+            score=score,
+            user_id=user_id,
+            date_achieved=date_achieved,
+            last_played=last_played
+        ))
+
+    today = datetime.utcnow().date()
+    start_of_day = datetime(today.year, today.month, today.day)
+    todays_scores = FlappyScore.query.filter(FlappyScore.date_achieved >= start_of_day)
+
+    db.session.add(FlappyStats(
+        id=STATS_ID,
+        games_played=FlappyScore.query.count(),
+        total_players=len(rows),
+        stats_day=today,
+        players_today=todays_scores.with_entities(FlappyScore.player_name).distinct().count(),
+        games_today=todays_scores.count()
+    ))
+    db.session.commit()
+
+
+def invalidate_leaderboard():
+    global _version
+    with _lock:
+        _version += 1
+
+
+def leaderboard_response(key, build_payload):
+    # Serve the cached JSON for `key`, rebuilding it with build_payload() only
+    # when stale. Clients sending a matching If-None-Match get a 304.
+    ttl = current_app.config.get('LEADERBOARD_CACHE_TTL', 5)
+    now = time.monotonic()
+
+    with _lock:
+        entry = _cache.get(key)
+        version = _version
+
+    if entry is None or entry['version'] != version or now - entry['built_at'] > ttl:
+        body = json.dumps(build_payload()).encode('utf-8')
+        entry = {
+            'version': version,
+            'built_at': now,
+            'body': body,
+            'etag': hashlib.sha1(body).hexdigest()
+        }
+        with _lock:
+            _cache[key] = entry
+
+    response = current_app.response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from werkzeug.exceptions import ServiceUnavailable
+from . import db
+from .background import BackgroundService
+from .leaderboard import STATS_ID, leaderboard_payload
+from .models import FlappyStats
+
+logger = logging.getLogger(__name__)
+
+# Live leaderboard for open game pages, as Server-Sent Events.
+#
+# One publisher thread per process watches FlappyStats.games_played (a
+# single-row primary key read) every LEADERBOARD_STREAM_POLL_SECONDS while
+# anyone is listening, so scores written by any gunicorn worker are seen.
+# A score written by this process wakes it straight away. Only when the
+# top 10 actually changes is a diff published (the changed ranks, the new
+# length and the counters); everything else is ignored.
+#
+# Each connected page waits on a condition variable between events, sending
+# a comment line every LEADERBOARD_STREAM_HEARTBEAT_SECONDS to keep proxies
+# from closing it. No connection touches the database after its first
+# snapshot. At most LEADERBOARD_STREAM_MAX_CLIENTS streams are open per
+# process (503 with Retry-After beyond that), and each is closed after
+# LEADERBOARD_STREAM_MAX_SECONDS; EventSource reconnects by itself.
+
+RECENT_EVENTS = 32  # diffs kept for streams that fall behind
+
+
+class TooManyStreams(ServiceUnavailable):
+    description = 'Too many live leaderboard connections. Please try again later.'
+
+
+def _event(name, data, event_id=None):
+    lines = [f'event: {name}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append('data: ' + json.dumps(data, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+def leaderboard_diff(old, new):
+    # Ranks whose entry changed, plus the new length
+    changes = [{'rank': rank, 'entry': entry} for rank, entry in enumerate(new)
+               if rank >= len(old) or old[rank] != entry]
+    return {'changes': changes, 'length': len(new)}
+
+
+class LeaderboardPublisher(BackgroundService):
+    name = 'leaderboard_publisher'
+
+    def configure(self, config):
+        config.setdefault('LEADERBOARD_STREAM_POLL_SECONDS', 1.0)
+        config.setdefault('LEADERBOARD_STREAM_HEARTBEAT_SECONDS', 15)
+        config.setdefault('LEADERBOARD_STREAM_MAX_CLIENTS',
+                          int(os.environ.get('LEADERBOARD_STREAM_MAX_CLIENTS', 32)))
+        config.setdefault('LEADERBOARD_STREAM_MAX_SECONDS', 600)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._clients = 0
+        self._version = 0
+        self._events = deque(maxlen=RECENT_EVENTS)  # (version, event text)
+        self._snapshot = None
+        self._marker = None
+        self._thread = None
+        self._stopping = False
+
+    def clients(self):
+        return self._clients
+
+    def notify(self):
+        # A score was written by this process; look now instead of next poll
+        self._wake.set()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._wake.set()
+
+    def subscribe(self):
+        # Reserve a stream slot and return (version, snapshot) to start from.
+        # Call inside a request; raises TooManyStreams when full. The slot is
+        # held until unsubscribe(), which the route hooks to response close
+        # so it is freed even when the body is never read (HEAD, errors).
+        with self._cond:
+            if self._clients >= self.app.config['LEADERBOARD_STREAM_MAX_CLIENTS']:
+                raise TooManyStreams(retry_after=30)
+            self._clients += 1
+            self._ensure_thread()
+            version, snapshot = self._version, self._snapshot
+
+        if snapshot is None:
+            # Nobody was listening, so the publisher has no snapshot yet. The
+            # one read here becomes its baseline, so no change is missed.
+            try:
+                snapshot = leaderboard_payload()
+            except Exception:
+                self.unsubscribe()
+                raise
+            with self._cond:
+                if self._snapshot is None and self._version == version:
+                    self._snapshot = snapshot
+                else:
+                    version, snapshot = self._version, self._snapshot
+        return version, snapshot
+
+    def unsubscribe(self):
+        with self._cond:
+            self._clients -= 1
+
+    def stream(self, version, snapshot):
+        # Body of one event-stream response. Ends when the client goes away
+        # (the next write fails) or the stream reaches its age limit.
+        config = self.app.config
+        closes_at = time.monotonic() + config['LEADERBOARD_STREAM_MAX_SECONDS']
+        yield 'retry: 5000\n\n'
+        yield _event('snapshot', snapshot, version)
+        while not self._stopping and time.monotonic() < closes_at:
+            with self._cond:
+                self._cond.wait_for(lambda: self._version > version or self._stopping,
+                                    timeout=config['LEADERBOARD_STREAM_HEARTBEAT_SECONDS'])
+                events = [(v, text) for v, text in self._events if v > version]
+                missed = self._version > version and (not events or events[0][0] > version + 1)
+                latest, current = self._version, self._snapshot
+
+            if missed:
+                # Fell further behind than RECENT_EVENTS; start over
+                yield _event('snapshot', current, latest)
+                version = latest
+            elif events:
+                for version, text in events:
+                    yield text
+            else:
+                yield ': ping\n\n'
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = self._start_thread(self._run, 'leaderboard-stream')
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.app.config['LEADERBOARD_STREAM_POLL_SECONDS'])
+            self._wake.clear()
+            with self._cond:
+                idle = not self._clients
+                if idle:
+                    # Nothing to keep fresh; the next subscriber reads its own snapshot
+                    self._snapshot = self._marker = None
+            if idle:
+                continue
+            with self.app.app_context():
+                try:
+                    self.poll()
+                except Exception:
+                    logger.exception('Error polling the leaderboard')
+                finally:
+                    db.session.remove()
+
+    def poll(self):
+        # Publish a diff if the top 10 changed since the last poll.
+        # Returns True when something was published.
+        marker = db.session.query(FlappyStats.games_played).filter(FlappyStats.id == STATS_ID).scalar()
+        if marker == self._marker and self._snapshot is not None:
+            return False
+
+        payload = leaderboard_payload()
+        self._marker = marker
+        with self._cond:
+            previous, self._snapshot = self._snapshot, payload
+        if previous is None or previous['leaderboard'] == payload['leaderboard']:
+            return False
+
+        diff = leaderboard_diff(previous['leaderboard'], payload['leaderboard'])
+        diff['stats'] = payload['stats']
+        with self._cond:
+            self._version += 1
+            self._events.append((self._version, _event('diff', diff, self._version)))
+            self._cond.notify_all()
+        return True
+
+
+leaderboard_publisher = LeaderboardPublisher()
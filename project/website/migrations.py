@@ -0,0 +1,117 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from . import db
+from .models import DataMigration, Note, Student, Teacher
+
+logger = logging.getLogger(__name__)
+
+# db.create_all() only creates missing tables; it never touches tables that
+# already exist. upgrade_database() fills the gap for existing database files
+# by adding any columns and indexes declared in models.py that the file does
+# not have yet. Every step checks first, so it is safe to run on each start.
+#
+# Data migrations rewrite existing rows once; each is recorded by name in the
+# data_migration table when it succeeds and skipped on later starts.
+
+
+def _column_ddl(column, dialect):
+    ddl = str(CreateColumn(column).compile(dialect=dialect))
+
+    # SQLite can only add a NOT NULL column when it has a constant default
+    if not column.nullable and column.server_default is None:
+        default = column.default
+        processor = column.type.literal_processor(dialect)
+        if default is not None and default.is_scalar and processor is not None:
+            ddl += f' DEFAULT {processor(default.arg)}'
+        else:
+            ddl = ddl.replace(' NOT NULL', '')
+    return ddl
+
+
+def _index_names(conn, inspector, table_name):
+    # The SQLite inspector leaves out expression indexes such as lower(name),
+    # so read their names from the schema table instead
+    if conn.dialect.name == 'sqlite':
+        return set(conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+        ), {'table': table_name}).scalars())
+    return {i['name'] for i in inspector.get_indexes(table_name)}
+
+
+def upgrade_database():
+    changes = []
+
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                conn.execute(text(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN {_column_ddl(column, conn.dialect)}'
+                ))
+                changes.append(f'column {table.name}.{column.name}')
+
+            existing_indexes = _index_names(conn, inspector, table.name)
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                index.create(conn)
+                changes.append(f'index {index.name}')
+
+    if changes:
+        logger.info('Upgraded database: added %s', ', '.join(changes))
+    return changes
+
+
+def _spread_positions():
+    # Dense 0, 1, 2... positions (or all 0 on old rows) become GAP-spaced keys
+    from .ordering import rebalance_positions
+    return rebalance_positions(Student) + rebalance_positions(Teacher)
+
+
+def _note_original_names():
+    # Attachments stored before the blob store kept their uploaded name as
+    # the file name; later ones are content hashes and their name is unknown
+    return Note.query.filter(
+        Note.original_name.is_(None),
+        Note.file_name.isnot(None),
+        Note.file_name != '',
+        ~Note.file_name.like('blobs/%')
+    ).update({Note.original_name: Note.file_name}, synchronize_session=False)
+
+
+def _drop_lower_name_indexes():
+    # Roster name search uses the NOCASE name indexes now
+    for name in ('ix_student_name_lower', 'ix_teacher_name_lower'):
+        db.session.execute(text(f'DROP INDEX IF EXISTS {name}'))
+    return 0
+
+
+DATA_MIGRATIONS = [
+    ('spread_positions', _spread_positions),
+    ('note_original_names', _note_original_names),
+    ('drop_lower_name_indexes', _drop_lower_name_indexes),
+]
+
+
+def run_data_migrations():
+    applied = {name for (name,) in db.session.query(DataMigration.name)}
+    ran = []
+    for name, migrate in DATA_MIGRATIONS:
+        if name in applied:
+            continue
+        rows = migrate()
+        db.session.add(DataMigration(name=name))
+        db.session.commit()
+        ran.append(f'{name} ({rows} rows)')
+
+    if ran:
+        logger.info('Applied data migrations: %s', ', '.join(ran))
+    return ran
@@ -4,9 +4,16 @@ from sqlalchemy.sql import func
 from datetime import datetime
 
 class Note(db.Model):
+    __table_args__ = (
+        db.Index('ix_note_public_date', 'public', 'date'),
+        db.Index('ix_note_public_subject_date', 'public', 'subject', 'date'),
+        db.Index('ix_note_user_date', 'user_id', 'date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     data = db.Column(db.String(1000))
     file_name = db.Column(db.String(300))
+    original_name = db.Column(db.String(300))  # Attachment's file name as uploaded
+    file_text = db.deferred(db.Column(db.Text))  # Text extracted from the attachment (see extraction.py)
     date = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     public = db.Column(db.Boolean, default=False)
@@ -24,6 +31,11 @@ class User(db.Model, UserMixin):
 
 
 class Student(db.Model):
+    __table_args__ = (
+        db.Index('ix_student_user_position', 'user_id', 'position'),
+        db.Index('ix_student_position', 'position'),
+        db.Index('ix_student_class_position', 'class_section', 'position'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
     age = db.Column(db.Integer, nullable=False)
@@ -35,7 +47,15 @@ class Student(db.Model):
     date_added = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
     position = db.Column(db.Integer, default=0)
 
+# Case-insensitive name prefix search on the student roster
+db.Index('ix_student_name_nocase', Student.name.collate('NOCASE'))
+
 class Teacher(db.Model):
+    __table_args__ = (
+        db.Index('ix_teacher_user_position', 'user_id', 'position'),
+        db.Index('ix_teacher_position', 'position'),
+        db.Index('ix_teacher_subject_position', 'subject', 'position'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
     age = db.Column(db.Integer, nullable=False)
@@ -47,6 +67,9 @@ class Teacher(db.Model):
     date_added = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
     position = db.Column(db.Integer, default=0)
 
+# Case-insensitive name prefix search on the teacher roster
+db.Index('ix_teacher_name_nocase', Teacher.name.collate('NOCASE'))
+
 class Game(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -54,15 +77,82 @@ class Game(db.Model):
     filename = db.Column(db.String(300))
     file_type = db.Column(db.String(50))  # 'web' or 'desktop'
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user = db.relationship('User')
     date_uploaded = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
     downloads = db.Column(db.Integer, default=0)
+    file_sha256 = db.Column(db.String(64))  # Content hash, used as the download ETag
+    # Manifest recorded at upload (see games.py)
+    entry_point = db.Column(db.String(300))  # Relative to GAMES_FOLDER
+    total_size = db.Column(db.Integer)  # Unpacked bytes
+    manifest = db.deferred(db.Column(db.JSON))  # {"files": [{"path", "size"}, ...]}
     requirements = db.Column(db.String(300))  # e.g., "tkinter, pillow"
     instructions = db.Column(db.String(500))  # How to play/run the game
 
 
 class FlappyScore(db.Model):
+    __table_args__ = (
+        db.Index('ix_flappy_score_player_score', 'player_name', 'score'),
+        db.Index('ix_flappy_score_date_player', 'date_achieved', 'player_name'),
+        db.Index('ix_flappy_score_score', 'score'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     player_name = db.Column(db.String(100), nullable=False)
     score = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    date_achieved = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
\ No newline at end of file
+    date_achieved = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+
+class FlappyBest(db.Model):
+    # One row per player holding their best game, maintained on every submit
+    id = db.Column(db.Integer, primary_key=True)
+    player_name = db.Column(db.String(100), nullable=False, unique=True)
+    score = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    date_achieved = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+    last_played = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+
+
+class FlappyStats(db.Model):
+    # Single row of rolling counters shown next to the leaderboard
+    id = db.Column(db.Integer, primary_key=True)
+    games_played = db.Column(db.Integer, nullable=False, default=0)
+    total_players = db.Column(db.Integer, nullable=False, default=0)
+    stats_day = db.Column(db.Date)
+    players_today = db.Column(db.Integer, nullable=False, default=0)
+    games_today = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Blob(db.Model):
+    # Content-addressed upload under UPLOAD_FOLDER, shared by every
+    # Note/Student/Teacher row whose file name points at it
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(300), nullable=False, unique=True)  # blobs/ab/<sha256>.<ext>
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    date_added = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+
+
+class DocumentText(db.Model):
+    # Text extracted from an uploaded document, one row per stored file.
+    # status: pending, running (claimed by a worker, see extraction.py), done,
+    # failed (gave up after retries) or unsupported
+    id = db.Column(db.Integer, primary_key=True)
+    file_name = db.Column(db.String(300), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500))
+    text = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+
+
+class DataMigration(db.Model):
+    # One row per data migration that has run (see migrations.py)
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime(timezone=True), default=datetime.utcnow)
+
+
+class CacheVersion(db.Model):
+    # Bumped on every write to the named table; keys the cached HTML
+    # fragments of that table's pages (see fragments.py)
+    name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,167 @@
+from bisect import bisect_left
+from collections import defaultdict
+from sqlalchemy import update
+from . import db
+
+# Student and Teacher rows are ordered by `position`, a sparse integer key
+# kept per user. New rows are placed GAP after the user's last row, and a
+# moved row gets a value between its new neighbours, so inserting or moving
+# one entry writes one row. Only when two neighbours have run out of room
+# (adjacent integers) is the user's list spread out again.
+#
+# That rebalance runs inline, in the same batched UPDATE as the move, rather
+# than in a background job: it only touches one user's list, with GAP = 1024
+# it is needed after about ten moves into the same spot, and doing it
+# right away means a list is never left without room. `flask
+# rebalance-positions` spreads every list out in one go.
+
+GAP = 1024
+
+
+def _owned_rows(model, user_id):
+    return (db.session.query(model.id, model.position)
+            .filter(model.user_id == user_id)
+            .order_by(model.position.asc(), model.id.asc())
+            .all())
+
+
+def _write_positions(model, changes):
+    if changes:
+        db.session.execute(update(model), changes)
+    return len(changes)
+
+
+def _spread(ids, current):
+    return [
+        {'id': item_id, 'position': (index + 1) * GAP}
+        for index, item_id in enumerate(ids)
+        if current.get(item_id) != (index + 1) * GAP
+    ]
+
+
+def _increasing_run(positions):
+    # Indexes of a longest strictly increasing run (not necessarily
+    # contiguous) of positions: those rows are already in the right order
+    # relative to each other and can keep their values.
+    tails, tail_indexes = [], []
+    previous = [None] * len(positions)
+    for index, value in enumerate(positions):
+        if value is None:
+            continue
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[k] = value
+            tail_indexes[k] = index
+        previous[index] = tail_indexes[k - 1] if k else None
+
+    kept = set()
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        kept.add(index)
+        index = previous[index]
+    return kept
+
+
+def _between(lower, upper, count):
+    # `count` increasing positions strictly between lower and upper (either
+    # may be None for an open end), or None if there is no room
+    if lower is None and upper is None:
+        return [(i + 1) * GAP for i in range(count)]
+    if lower is None:
+        return [upper - (count - i) * GAP for i in range(count)]
+    if upper is None:
+        return [lower + (i + 1) * GAP for i in range(count)]
+
+    step = (upper - lower) // (count + 1)
+    if step < 1:
+        return None
+    return [lower + (i + 1) * step for i in range(count)]
+
+
+def _reposition(model, ids, current):
+    # Give `ids` increasing positions, rewriting as few rows as possible
+    kept = _increasing_run([current.get(item_id) for item_id in ids])
+
+    changes = []
+    pending = []
+    lower = None
+    for index, item_id in enumerate(ids):
+        if index not in kept:
+            pending.append(item_id)
+            continue
+        upper = current[item_id]
+        if pending:
+            positions = _between(lower, upper, len(pending))
+            if positions is None:
+                return _write_positions(model, _spread(ids, current))
+            changes.extend({'id': i, 'position': p} for i, p in zip(pending, positions))
+            pending = []
+        lower = upper
+
+    if pending:
+        changes.extend({'id': i, 'position': p}
+                       for i, p in zip(pending, _between(lower, None, len(pending))))
+    return _write_positions(model, changes)
+
+
+def next_position(model, user_id):
+    # Position for a new row at the end of the user's list
+    last = db.session.query(db.func.max(model.position)).filter(model.user_id == user_id).scalar()
+    return GAP if last is None else last + GAP
+
+
+def apply_order(model, user_id, ordered_ids):
+    # Full reorder: the user's rows follow the order of ordered_ids. Ids the
+    # user doesn't own are ignored; owned rows missing from the list go
+    # after the listed ones, in their current order.
+    rows = _owned_rows(model, user_id)
+    current = dict(rows)
+
+    ids = []
+    seen = set()
+    for item_id in ordered_ids:
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            continue
+        if item_id in current and item_id not in seen:
+            ids.append(item_id)
+            seen.add(item_id)
+    ids += [row_id for row_id, _ in rows if row_id not in seen]
+
+    return _reposition(model, ids, current)
+
+
+def move_item(model, user_id, item_id, index):
+    # Move one of the user's rows to `index` within the user's own rows.
+    # Returns the number of rows updated, or None if the row isn't theirs.
+    rows = _owned_rows(model, user_id)
+    ids = [row_id for row_id, _ in rows]
+    if item_id not in ids:
+        return None
+
+    ids.remove(item_id)
+    ids.insert(max(0, min(index, len(ids))), item_id)
+    return _reposition(model, ids, dict(rows))
+
+
+def rebalance_positions(model, user_id=None):
+    # Spread every user's rows (or one user's) GAP apart, keeping their
+    # order. Returns the number of rows updated; the caller commits.
+    query = db.session.query(model.id, model.position, model.user_id)
+    if user_id is not None:
+        query = query.filter(model.user_id == user_id)
+
+    lists = defaultdict(list)
+    current = {}
+    for row_id, position, owner in query.order_by(model.user_id, model.position, model.id):
+        lists[owner].append(row_id)
+        current[row_id] = position
+
+    changes = []
+    for ids in lists.values():
+        changes.extend(_spread(ids, current))
+    return _write_positions(model, changes)
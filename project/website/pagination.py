@@ -0,0 +1,62 @@
+import base64
+from datetime import datetime
+from . import db
+
+# Keyset (cursor) pagination. Instead of OFFSET, each page remembers the sort
+# key of its last row and the next page starts strictly after it, so fetching
+# page 500 costs the same index seek as fetching page 1.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(key, row_id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    raw = f'{key}|{row_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, parse_key=datetime.fromisoformat):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        key, row_id = raw.split('|')
+        return parse_key(key), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def keyset_page(query, date_column, id_column, cursor=None, limit=20):
+    # Newest first over (date, id). Returns (rows, next_cursor or None).
+    if cursor:
+        date, row_id = decode_cursor(cursor)
+        query = query.filter(db.or_(
+            date_column < date,
+            db.and_(date_column == date, id_column < row_id)
+        ))
+
+    rows = query.order_by(date_column.desc(), id_column.desc()).limit(limit + 1).all()
+    return _split_page(rows, date_column, id_column, limit)
+
+
+def ordered_page(query, position_column, id_column, cursor=None, limit=20):
+    # Lowest first over an integer (position, id). Returns (rows, next_cursor or None).
+    if cursor:
+        position, row_id = decode_cursor(cursor, parse_key=int)
+        query = query.filter(db.or_(
+            position_column > position,
+            db.and_(position_column == position, id_column > row_id)
+        ))
+
+    rows = query.order_by(position_column.asc(), id_column.asc()).limit(limit + 1).all()
+    return _split_page(rows, position_column, id_column, limit)
+
+
+def _split_page(rows, key_column, id_column, limit):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, key_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+from .background import BackgroundService
+from .metrics import registry
+
+# Password hashing runs on a small pool of PASSWORD_HASH_WORKERS threads.
+# pbkdf2 (and scrypt) release the GIL while they work, so the pool hashes in
+# parallel without extra processes. It also caps how much CPU a burst of
+# logins can take from a worker.
+#
+# Admission control: at most PASSWORD_HASH_MAX_PENDING hashes may be running
+# or queued at once. Past that, a request fails fast with 503 and a
+# Retry-After header instead of queueing behind a whole class logging in.
+#
+# PASSWORD_HASH_METHOD sets the cost (e.g. pbkdf2:sha256:600000). Stored
+# hashes made with a different method are rehashed on the next successful
+# login. With PASSWORD_HASH_SYNC (on automatically when TESTING) hashing runs
+# inside the request.
+
+HASH_LATENCY = registry.histogram(
+    'password_hash_duration_seconds', 'Time to hash or check a password, including the wait for a worker.',
+    ('operation',))
+HASH_REJECTED = registry.counter(
+    'password_hash_rejected_total', 'Password hashes refused because the pool was full.')
+
+
+def canonical_method(method):
+    # Werkzeug hashes start with the method they were made with, with every
+    # parameter filled in ('scrypt' is written as scrypt:32768:8:1). Spelled
+    # out here the same way, so checking a hash never costs a second hash.
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        return 'scrypt:' + ':'.join(args or ['32768', '8', '1'])
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    return method
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = 'The server is busy signing people in. Please try again in a moment.'
+
+
+class PasswordHasher(BackgroundService):
+    name = 'password_hasher'
+    sync_setting = 'PASSWORD_HASH_SYNC'
+
+    def configure(self, config):
+        config.setdefault('PASSWORD_HASH_METHOD', os.environ.get(
+            'PASSWORD_HASH_METHOD', f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}'))
+        config.setdefault('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1))
+        config.setdefault('PASSWORD_HASH_MAX_PENDING', 4 * config['PASSWORD_HASH_WORKERS'])
+        config.setdefault('PASSWORD_HASH_RETRY_AFTER', 2)  # seconds, sent with the 503
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+
+    @property
+    def method(self):
+        return self.app.config['PASSWORD_HASH_METHOD']
+
+    def pending(self):
+        return self._pending
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run('check', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != canonical_method(self.method)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, operation, func, *args):
+        start = time.perf_counter()
+        if self.sync:
+            result = func(*args)
+        else:
+            with self._lock:
+                if self._pending >= self.app.config['PASSWORD_HASH_MAX_PENDING']:
+                    HASH_REJECTED.inc()
+                    raise PasswordHasherBusy(
+                        retry_after=self.app.config['PASSWORD_HASH_RETRY_AFTER'])
+                self._pending += 1
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.app.config['PASSWORD_HASH_WORKERS'], thread_name_prefix='password-hash')
+                future = self._executor.submit(func, *args)
+            try:
+                result = future.result()
+            finally:
+                with self._lock:
+                    self._pending -= 1
+        HASH_LATENCY.observe(time.perf_counter() - start, operation=operation)
+        return result
+
+
+password_hasher = PasswordHasher()
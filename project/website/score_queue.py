@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from werkzeug.exceptions import BadRequest
+from . import db
+from .background import BackgroundService
+from .models import FlappyScore
+from .leaderboard import record_score, invalidate_leaderboard
+from .leaderboard_stream import leaderboard_publisher
+
+logger = logging.getLogger(__name__)
+
+# Finished Flappy Bird games are buffered here and written in batches, so a
+# burst of submissions costs one transaction (and one fsync) per batch
+# instead of one per game. A batch is flushed every SCORE_QUEUE_FLUSH_MS
+# milliseconds or as soon as SCORE_QUEUE_BATCH_SIZE scores are waiting.
+#
+# At most SCORE_QUEUE_MAX_PENDING scores are held in memory; once full, the
+# submitting request flushes the buffer itself instead of growing it further.
+# With SCORE_QUEUE_SYNC (on automatically when TESTING) every score is written
+# inside the request, as before.
+#
+# Scores are checked on submit (an integer from 0 to SCORE_MAX) so one bad
+# value can't fail a whole batch. If a batch still fails, its scores are
+# written one at a time; any that fail again go back in the buffer and are
+# dropped after SCORE_QUEUE_MAX_ATTEMPTS tries.
+
+
+class InvalidScore(BadRequest):
+    description = 'Score must be a whole number.'
+
+
+class ScoreQueue(BackgroundService):
+    name = 'score_queue'
+    sync_setting = 'SCORE_QUEUE_SYNC'
+
+    def configure(self, config):
+        config.setdefault('SCORE_QUEUE_FLUSH_MS', 250)
+        config.setdefault('SCORE_QUEUE_BATCH_SIZE', 100)
+        config.setdefault('SCORE_QUEUE_MAX_PENDING', 5000)
+        config.setdefault('SCORE_QUEUE_MAX_ATTEMPTS', 3)
+        config.setdefault('SCORE_MAX', 1000000)
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._stopping = False
+        self._flush_lock = threading.Lock()
+
+    def validate(self, score):
+        # The score as an int; raises InvalidScore (400) for anything else
+        if isinstance(score, bool) or not isinstance(score, (int, float, str)):
+            raise InvalidScore()
+        try:
+            value = int(score)
+        except (ValueError, OverflowError):
+            raise InvalidScore()
+        if value != score and str(value) != score:
+            raise InvalidScore()  # 2.5, 'nan', ' 7'
+        if not 0 <= value <= self.app.config['SCORE_MAX']:
+            raise InvalidScore(f"Score must be between 0 and {self.app.config['SCORE_MAX']}.")
+        return value
+
+    def submit(self, player_name, score, user_id):
+        item = (player_name, self.validate(score), user_id, datetime.utcnow(), 0)
+
+        if self.sync:
+            self._write([item])
+            return
+
+        with self._cond:
+            full = len(self._pending) >= self.app.config['SCORE_QUEUE_MAX_PENDING']
+            if not full:
+                self._pending.append(item)
+                self._ensure_thread()
+                if len(self._pending) >= self.app.config['SCORE_QUEUE_BATCH_SIZE']:
+                    self._cond.notify()
+
+        if full:
+            # Apply backpressure: drain the buffer on this request's thread
+            self.flush()
+            self._write([item])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if batch:
+                with self.app.app_context():
+                    self._write(batch)
+
+    def shutdown(self):
+        # Write whatever is still buffered before the process exits
+        self._stopping = True
+        with self._cond:
+            self._cond.notify_all()
+        self.flush()
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = self._start_thread(self._run, 'score-queue')
+
+    def _run(self):
+        while not self._stopping:
+            interval = self.app.config['SCORE_QUEUE_FLUSH_MS'] / 1000.0
+            deadline = time.monotonic() + interval
+            with self._cond:
+                while (len(self._pending) < self.app.config['SCORE_QUEUE_BATCH_SIZE']
+                       and time.monotonic() < deadline):
+                    self._cond.wait(max(deadline - time.monotonic(), 0))
+            try:
+                self.flush()
+            except Exception:
+                pass  # already logged by _write; keep the flusher alive
+
+    def _insert(self, batch):
+        for player_name, score, user_id, achieved_at, attempts in batch:
+            db.session.add(FlappyScore(
+                player_name=player_name,
+                score=score,
+                user_id=user_id,
+                date_achieved=achieved_at
+            ))
+            record_score(player_name, score, user_id, achieved_at)
+        db.session.commit()
+
+    def _write(self, batch):
+        try:
+            self._insert(batch)
+        except Exception as e:
+            db.session.rollback()
+            # Drop the batch's objects so the retries start from a clean session
+            db.session.expunge_all()
+            if self.sync:
+                logger.error('Error writing score: %s', e)
+                raise
+            logger.warning('Error writing %d queued scores, retrying one at a time: %s', len(batch), e)
+            self._write_each(batch)
+        invalidate_leaderboard()
+        leaderboard_publisher.notify()
+
+    def _write_each(self, batch):
+        # Keep the scores that can be written; put the rest back for later
+        failed = []
+        for item in batch:
+            try:
+                self._insert([item])
+            except Exception as e:
+                db.session.rollback()
+                db.session.expunge_all()
+                attempts = item[4] + 1
+                if attempts >= self.app.config['SCORE_QUEUE_MAX_ATTEMPTS']:
+                    logger.error('Dropping score %s for %r after %d attempts: %s',
+                                 item[1], item[0], attempts, e)
+                else:
+                    failed.append(item[:4] + (attempts,))
+        if failed:
+            with self._cond:
+                self._pending[:0] = failed
+
+
+score_queue = ScoreQueue()
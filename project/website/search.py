@@ -0,0 +1,139 @@
+import logging
+import re
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload, undefer
+from . import db
+from .models import Note
+
+logger = logging.getLogger(__name__)
+
+# Full-text search over notes, backed by an SQLite FTS5 index.
+#
+# note_fts is an external-content FTS5 table: it stores only the index and
+# reads note text from the note table by rowid (= note.id). Triggers on note
+# keep it in step with every insert, update and delete, whichever code path
+# makes them. Visibility (public / owner) is not indexed; it is checked on
+# note itself, so toggle_share takes effect on the next search. Text
+# extracted from attachments (Note.file_text, see extraction.py) is indexed
+# when the extraction worker writes it.
+
+FTS_TABLE = 'note_fts'
+
+COLUMNS = ('data', 'subject', 'original_name', 'file_text')
+
+# Column weights for bm25 ranking, in COLUMNS order
+RANK = 'bm25(10.0, 5.0, 2.0, 1.0)'
+
+MAX_TERMS = 8
+
+_columns = ', '.join(COLUMNS)
+_new_values = ', '.join('new.' + column for column in COLUMNS)
+_old_values = ', '.join('old.' + column for column in COLUMNS)
+
+TRIGGERS = ('note_fts_insert', 'note_fts_delete', 'note_fts_update')
+
+_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        {_columns},
+        content='note', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS note_fts_insert AFTER INSERT ON note BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.id, {_new_values});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS note_fts_delete AFTER DELETE ON note BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.id, {_old_values});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS note_fts_update AFTER UPDATE OF {_columns} ON note BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_columns}) VALUES ('delete', old.id, {_old_values});
+        INSERT INTO {FTS_TABLE}(rowid, {_columns}) VALUES (new.id, {_new_values});
+    END""",
+]
+
+_fts = db.table(FTS_TABLE, db.column('rowid'), db.column('rank'))
+
+
+def init_search():
+    # Create the index and its triggers if missing, and fill it from the
+    # existing notes the first time. Safe to run on every start.
+    with db.engine.begin() as conn:
+        if conn.dialect.name != 'sqlite':
+            logger.warning('Note search needs SQLite FTS5; search is disabled')
+            return False
+
+        existing = tuple(row[1] for row in conn.execute(text(f"PRAGMA table_info({FTS_TABLE})")))
+        exists = existing == COLUMNS
+        if existing and not exists:
+            # Indexed columns changed; FTS5 tables can't be altered, so rebuild
+            for trigger in TRIGGERS:
+                conn.execute(text(f'DROP TRIGGER IF EXISTS {trigger}'))
+            conn.execute(text(f'DROP TABLE {FTS_TABLE}'))
+
+        for statement in _SCHEMA:
+            conn.execute(text(statement))
+
+        if not exists:
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', :rank)"),
+                         {'rank': RANK})
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+            logger.info('Built note search index')
+    return True
+
+
+def rebuild_search_index():
+    with db.engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')"))
+
+
+def match_expression(query):
+    # Every word becomes a quoted prefix term ("word"*), all of which must
+    # match. Quoting keeps FTS5 operators in user input from being parsed.
+    terms = re.findall(r'\w+', (query or '').lower())[:MAX_TERMS]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _visible_to(user_id, scope):
+    if scope == 'mine':
+        return Note.user_id == user_id
+    if scope == 'shared':
+        return Note.public == True
+    return db.or_(Note.public == True, Note.user_id == user_id)
+
+
+def search_notes(user_id, query, subject=None, scope='all', page=1, per_page=20):
+    # Ranked notes matching `query` that the user may see, one page at a
+    # time, plus how many matches there are per subject.
+    result = {'notes': [], 'facets': [], 'total': 0, 'page': page, 'has_more': False}
+    match = match_expression(query)
+    if not match:
+        return result
+
+    matched = text(f'{FTS_TABLE} MATCH :match').bindparams(match=match)
+    visible = _visible_to(user_id, scope)
+
+    # Facet counts ignore the subject filter so other subjects stay selectable
+    facets = (db.session.query(Note.subject, db.func.count())
+              .join(_fts, _fts.c.rowid == Note.id)
+              .filter(matched, visible)
+              .group_by(Note.subject)
+              .order_by(db.func.count().desc(), Note.subject)
+              .all())
+    result['facets'] = [{'subject': name, 'count': count} for name, count in facets]
+
+    query = (Note.query.options(joinedload(Note.user), undefer(Note.file_text))
+             .join(_fts, _fts.c.rowid == Note.id)
+             .filter(matched, visible))
+    if subject:
+        query = query.filter(Note.subject == subject)
+        result['total'] = sum(count for name, count in facets if name == subject)
+    else:
+        result['total'] = sum(count for _, count in facets)
+
+    notes = (query.order_by(_fts.c.rank, Note.id.desc())
+             .offset((page - 1) * per_page)
+             .limit(per_page + 1)
+             .all())
+    result['has_more'] = len(notes) > per_page
+    result['notes'] = notes[:per_page]
+    return result
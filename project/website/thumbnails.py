@@ -0,0 +1,133 @@
+import logging
+import os
+from flask import current_app, url_for
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional; pages fall back to the original image
+    Image = None
+
+# Profile pictures are shown as 150px circles, but the originals are often
+# several hundred KB. When a picture is uploaded we render square crops at
+# each of THUMBNAIL_SIZES (1x and 2x) as JPEG, plus WebP when Pillow supports
+# it, under UPLOAD_FOLDER/thumbs/. Templates use profile_pic_variants() to
+# reference those and only fall back to the original when none exist yet.
+
+THUMBNAIL_DIR = 'thumbs'
+THUMBNAIL_SIZES = (150, 300)
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp'}
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def variant_name(name, size, fmt):
+    base = name.rsplit('.', 1)[0]
+    return f'{THUMBNAIL_DIR}/{base}-{size}.{fmt}'
+
+
+def _path(name):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], *name.split('/'))
+
+
+def _formats():
+    formats = ['jpg']
+    if Image is not None and features.check('webp'):
+        formats.append('webp')
+    return formats
+
+
+def _exists(name):
+    # Always asked of the disk: another worker may have deleted the
+    # variants (or written them) since. Rendered cards are cached in
+    # fragments.py, so this doesn't run on every page view.
+    return os.path.exists(_path(name))
+
+
+def is_image(name):
+    return bool(name) and '.' in name and name.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def generate_variants(name, force=False, source=None):
+    # Render every missing thumbnail for an uploaded image, read from
+    # `source` (e.g. a staged upload) or the stored file. Returns the
+    # number of files written; raises InvalidImage when Pillow can't decode
+    # the file or it would decode to an oversized bitmap.
+    if Image is None or not is_image(name):
+        return 0
+
+    wanted = [(size, fmt) for size in current_app.config['THUMBNAIL_SIZES'] for fmt in _formats()
+              if force or not _exists(variant_name(name, size, fmt))]
+    if not wanted:
+        return 0
+
+    written = 0
+    try:
+        with Image.open(source or _path(name)) as original:
+            image = ImageOps.exif_transpose(original)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # Flatten transparency onto white; JPEG has no alpha channel
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning('Could not read image %s for thumbnails: %s', name, e)
+        raise InvalidImage(str(e)) from e
+
+    for size, fmt in wanted:
+        thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        variant = variant_name(name, size, fmt)
+        path = _path(variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write next to the target and rename, so readers never see half a file
+        tmp_path = path + '.tmp'
+        if fmt == 'webp':
+            thumb.save(tmp_path, 'WEBP', quality=80, method=4)
+        else:
+            thumb.save(tmp_path, 'JPEG', quality=82, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+        written += 1
+    return written
+
+
+def remove_variants(name):
+    if not name:
+        return
+    for size in current_app.config['THUMBNAIL_SIZES']:
+        for fmt in ('jpg', 'webp'):
+            path = _path(variant_name(name, size, fmt))
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def profile_pic_variants(name):
+    # URLs for a profile picture: `src` (and `srcset`) for the <img>, plus
+    # `webp_srcset` for a <source> when WebP thumbnails exist.
+    def url(variant):
+        return url_for('static', filename='uploads/' + variant)
+
+    small, large = current_app.config['THUMBNAIL_SIZES'][:2]
+    result = {'src': url(name), 'srcset': None, 'webp_srcset': None}
+
+    if _exists(variant_name(name, small, 'jpg')):
+        result['src'] = url(variant_name(name, small, 'jpg'))
+        if _exists(variant_name(name, large, 'jpg')):
+            result['srcset'] = f"{result['src']} 1x, {url(variant_name(name, large, 'jpg'))} 2x"
+
+    if _exists(variant_name(name, small, 'webp')):
+        result['webp_srcset'] = url(variant_name(name, small, 'webp')) + ' 1x'
+        if _exists(variant_name(name, large, 'webp')):
+            result['webp_srcset'] += f", {url(variant_name(name, large, 'webp'))} 2x"
+    return result
+
+
+def init_thumbnails(app):
+    app.config.setdefault('THUMBNAIL_SIZES', THUMBNAIL_SIZES)
+    app.jinja_env.globals['profile_pic_variants'] = profile_pic_variants
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from flask import Request, current_app, flash, jsonify, redirect, request, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+from .instrumentation import record_upload
+
+# Upload pipeline. Werkzeug normally spools every uploaded file into a
+# temporary file and file.save() then copies it to its destination. Here the
+# multipart parser writes each file straight into a temp file on the same
+# disk, in the parser's fixed-size chunks, while hashing it and checking it
+# against a per-extension size limit. move_to() then renames the temp
+# file into place, so the bytes are written once and never held in memory.
+#
+# MAX_CONTENT_LENGTH (the largest per-type limit plus room for form fields)
+# rejects requests whose Content-Length is too big before anything is read.
+
+MB = 1024 * 1024
+
+UPLOAD_SIZE_LIMITS = {
+    'txt': 2 * MB,
+    'pdf': 25 * MB,
+    'docx': 15 * MB,
+    'png': 8 * MB,
+    'jpg': 8 * MB,
+    'jpeg': 8 * MB,
+    'py': 1 * MB,
+    'html': 2 * MB,
+    'js': 2 * MB,
+    'zip': 50 * MB,
+}
+DEFAULT_UPLOAD_LIMIT = 10 * MB
+CHUNK_SIZE = 64 * 1024
+
+
+def size_limit_for(filename):
+    limits = current_app.config['UPLOAD_SIZE_LIMITS']
+    ext = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+    return limits.get(ext, current_app.config['DEFAULT_UPLOAD_LIMIT'])
+
+
+class StreamedUpload:
+    # Writable temp file that hashes and size-checks data as it arrives.
+    # Anything not moved into place with move_to() is deleted on close().
+
+    def __init__(self, directory, filename, limit):
+        self.file = tempfile.NamedTemporaryFile(
+            'w+b', dir=directory, prefix='upload-', suffix='.part', delete=False
+        )
+        self.path = self.file.name
+        self.filename = filename
+        self.limit = limit
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.finalized = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            self.close()
+            raise RequestEntityTooLarge(
+                f'{self.filename} is larger than the {self.limit // MB} MB limit for this file type.'
+            )
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        # read/seek/tell/etc. for FileStorage
+        if name == 'file':
+            raise AttributeError(name)
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    @property
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def move_to(self, destination):
+        self.file.flush()
+        self.file.close()
+        try:
+            os.replace(self.path, destination)
+        except OSError:
+            # Different filesystem; fall back to a copy
+            shutil.move(self.path, destination)
+        self.finalized = True
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        if not self.finalized and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = size_limit_for(filename)
+        if content_length and content_length > limit:
+            raise RequestEntityTooLarge(
+                f'{filename} is larger than the {limit // MB} MB limit for this file type.'
+            )
+
+        stream = StreamedUpload(current_app.config['UPLOAD_TMP_FOLDER'], filename, limit)
+        self.__dict__.setdefault('_upload_streams', []).append(stream)
+        return stream
+
+    def close(self):
+        super().close()
+        # Also covers parts left behind when parsing aborted half-way
+        for stream in self.__dict__.pop('_upload_streams', []):
+            stream.close()
+
+
+def stage_upload(file_storage):
+    # Return the upload as a StreamedUpload (already hashed and on disk).
+    # Files that bypassed UploadRequest are copied into one first. Only
+    # files staged here, i.e. taken by an upload route, are recorded in
+    # the upload metrics.
+    stream = file_storage.stream
+    if isinstance(stream, StreamedUpload):
+        staged = stream
+    else:
+        staged = StreamedUpload(current_app.config['UPLOAD_TMP_FOLDER'], file_storage.filename,
+                                size_limit_for(file_storage.filename))
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            staged.write(chunk)
+    record_upload(staged.filename, staged.size)
+    return staged
+
+
+def _wants_json():
+    return request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+
+def init_uploads(app):
+    app.request_class = UploadRequest
+    app.config.setdefault('UPLOAD_SIZE_LIMITS', UPLOAD_SIZE_LIMITS)
+    app.config.setdefault('DEFAULT_UPLOAD_LIMIT', DEFAULT_UPLOAD_LIMIT)
+    app.config.setdefault(
+        'MAX_CONTENT_LENGTH',
+        max([DEFAULT_UPLOAD_LIMIT] + list(app.config['UPLOAD_SIZE_LIMITS'].values())) + MB
+    )
+    # Created with the other folders in prepare_app()
+    app.config.setdefault('UPLOAD_TMP_FOLDER', os.path.join(app.instance_path, 'upload-tmp'))
+
+    @app.errorhandler(RequestEntityTooLarge)
+    def upload_too_large(e):
+        message = (e.description if e.description != RequestEntityTooLarge.description
+                   else 'File is too large.')
+        # JSON callers get a 413 they can read; form posts go back with a message
+        if request.is_json or _wants_json():
+            return jsonify({'success': False, 'error': message}), 413
+        flash(message, 'error')
+        return redirect(request.referrer or url_for('views.home'))
@@ -1,11 +1,20 @@
-import os 
-from flask import Blueprint, redirect, render_template, request, flash , jsonify, current_app, url_for
+import logging
+from flask import Blueprint, Response, redirect, render_template, request, flash , jsonify, current_app, url_for
 from flask_login import login_required, current_user
-from .models import Note, FlappyScore
-from . import UPLOAD_FOLDER, db
+from .models import Note
+from . import db
+from .leaderboard import leaderboard_payload, leaderboard_response
+from .leaderboard_stream import leaderboard_publisher
+from .score_queue import InvalidScore, score_queue
+from .pagination import InvalidCursor, keyset_page
+from .search import search_notes
+from .extraction import attach_document, extraction_pool, forget_document
+from .blobstore import store_upload, release_upload, remove_released
+from sqlalchemy.orm import joinedload
 import json
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
 
 views = Blueprint('views', __name__)
 
@@ -18,23 +27,38 @@ def home():
         subject = request.form.get('subject', 'General')
 
         file_name = None
+        original_name = None
         if file and file.filename != '':
-            file_name = secure_filename(file.filename)
-            file.save(os.path.join(UPLOAD_FOLDER, file_name))
+            file_name = store_upload(file)
+            original_name = secure_filename(file.filename)
 
         new_note = Note(
             data=note_data, 
             user_id=current_user.id, 
             file_name=file_name, 
+            original_name=original_name,
             public=False,
             subject=subject
         )
         db.session.add(new_note)
+        extract = attach_document(new_note)
         db.session.commit()
+        if extract:
+            # Text is extracted in the background, after this response
+            extraction_pool.submit(file_name)
         flash('Note added successfully!', 'success')
         return redirect(url_for('views.home'))
 
-    return render_template("home.html", user=current_user)
+    # One ordered, bounded query for just the columns home.html shows
+    notes = db.session.query(
+        Note.id, Note.subject, Note.data, Note.file_name, Note.public
+    ).filter(
+        Note.user_id == current_user.id
+    ).order_by(
+        Note.date.desc(), Note.id.desc()
+    ).limit(current_app.config['HOME_NOTES_LIMIT']).all()
+
+    return render_template("home.html", user=current_user, notes=notes)
 
 @views.route('/delete-note', methods=['POST'])
 @login_required
@@ -42,34 +66,36 @@ def delete_note():
     try:
         data = json.loads(request.data)
         noteId = data.get('noteId')
-        print(f"🎯 DELETE REQUEST - Note ID: {noteId}, Current User ID: {current_user.id}")
+        logger.debug('Delete request for note %s by user %s', noteId, current_user.id)
         
         note = Note.query.get(noteId)
         
         if not note:
-            print("❌ Note not found")
+            logger.debug('Note %s not found', noteId)
             return jsonify({'error': 'Note not found'}), 404
         
-        print(f"📝 Note found - Note User ID: {note.user_id}, Current User ID: {current_user.id}")
+        logger.debug('Note %s belongs to user %s', noteId, note.user_id)
         
         if note.user_id != current_user.id:
-            print("🚫 Authorization failed: User doesn't own this note")
+            logger.warning('User %s tried to delete note %s of user %s', current_user.id, noteId, note.user_id)
             return jsonify({'error': 'Not authorized'}), 403
         
-        # Delete the file if it exists
-        if note.file_name:
-            file_path = os.path.join(UPLOAD_FOLDER, note.file_name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"🗑️ Deleted file: {note.file_name}")
+        # Drop this note's reference to its file; shared files stay
+        released = release_upload(note.file_name)
+        if released:
+            forget_document(note.file_name)
         
         db.session.delete(note)
         db.session.commit()
-        print("✅ Note deleted successfully")
+        
+        # Delete the file once nothing references it
+        if remove_released(released):
+            logger.info('Deleted file %s', note.file_name)
+        logger.debug('Note %s deleted', noteId)
         return jsonify({'success': True})
         
-    except Exception as e:
-        print(f"💥 Error in delete_note: {str(e)}")
+    except Exception:
+        logger.exception('Error in delete_note')
         return jsonify({'error': 'Server error'}), 500
 
 def allowed_file(filename):
@@ -81,13 +107,16 @@ def upload_file():
     file = request.files.get('file')
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        # FIXED: Use current_app instead of app
-        file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+        file_name = store_upload(file)
         
         # Create a note entry in the database
-        new_note = Note(data=f"Uploaded file: {filename}", file_name=filename, user_id=current_user.id)
+        new_note = Note(data=f"Uploaded file: {filename}", file_name=file_name, original_name=filename,
+                        user_id=current_user.id)
         db.session.add(new_note)
+        extract = attach_document(new_note)
         db.session.commit()
+        if extract:
+            extraction_pool.submit(file_name)
         
         flash('File uploaded successfully!', 'success')
     else:
@@ -98,8 +127,79 @@ def upload_file():
 @views.route('/notes')
 @login_required
 def notes():
-    shared_notes = Note.query.filter_by(public=True).all()
-    return render_template("note.html", notes=shared_notes, user=current_user)
+    shared_notes, next_cursor = _public_notes_page()
+    return render_template("note.html", notes=shared_notes, next_cursor=next_cursor, user=current_user)
+
+@views.route('/api/notes')
+@login_required
+def notes_feed():
+    # JSON pages of the shared notes feed, used by note.html for infinite scroll
+    try:
+        shared_notes, next_cursor = _public_notes_page(
+            cursor=request.args.get('cursor'),
+            subject=request.args.get('subject'),
+            limit=request.args.get('limit', type=int)
+        )
+    except InvalidCursor:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    return jsonify({
+        'notes': [_note_json(note) for note in shared_notes],
+        'next_cursor': next_cursor
+    })
+
+def _note_json(note, preview=False):
+    data = {
+        'id': note.id,
+        'subject': note.subject,
+        'data': note.data,
+        'author': note.user.first_name if note.user else None,
+        'file_url': url_for('static', filename='uploads/' + note.file_name) if note.file_name else None,
+        'file_label': note.original_name,
+        'date': note.date.strftime('%b %d, %Y, %I:%M %p')
+    }
+    if preview:
+        data['preview'] = note.file_text[:300] if note.file_text else None
+    return data
+
+def _public_notes_page(cursor=None, subject=None, limit=None):
+    page_size = current_app.config['NOTES_PAGE_SIZE']
+    limit = max(1, min(limit or page_size, current_app.config['NOTES_MAX_PAGE_SIZE']))
+
+    query = Note.query.options(joinedload(Note.user)).filter(Note.public == True)
+    if subject and subject != 'all':
+        query = query.filter(Note.subject == subject)
+    return keyset_page(query, Note.date, Note.id, cursor=cursor, limit=limit)
+
+def _search_args():
+    scope = request.args.get('scope', 'all')
+    return {
+        'query': request.args.get('q', ''),
+        'subject': request.args.get('subject') or None,
+        'scope': scope if scope in ('all', 'mine', 'shared') else 'all',
+        'page': max(request.args.get('page', 1, type=int), 1)
+    }
+
+@views.route('/search')
+@login_required
+def search():
+    args = _search_args()
+    results = search_notes(current_user.id, per_page=current_app.config['SEARCH_PAGE_SIZE'], **args)
+    return render_template("search.html", user=current_user, results=results, **args)
+
+@views.route('/api/search')
+@login_required
+def search_feed():
+    # Ranked note search: q, subject, scope (all/mine/shared), page
+    args = _search_args()
+    results = search_notes(current_user.id, per_page=current_app.config['SEARCH_PAGE_SIZE'], **args)
+    return jsonify({
+        'notes': [_note_json(note, preview=True) for note in results['notes']],
+        'facets': results['facets'],
+        'total': results['total'],
+        'page': results['page'],
+        'has_more': results['has_more']
+    })
 
 @views.route('/toggle-share', methods=['POST'])
 @login_required
@@ -109,26 +209,26 @@ def toggle_share():
         note_id = data.get('noteId')
         make_public = data.get('public')
         
-        print(f"🎯 TOGGLE SHARE - Note ID: {note_id}, Make Public: {make_public}, User: {current_user.id}")
+        logger.debug('Toggle share for note %s (public=%s) by user %s', note_id, make_public, current_user.id)
         
         note = Note.query.get(note_id)
         
         if not note:
-            print("❌ Note not found")
+            logger.debug('Note %s not found', note_id)
             return jsonify({'error': 'Note not found'}), 404
         
         if note.user_id != current_user.id:
-            print("🚫 Authorization failed")
+            logger.warning('User %s tried to share note %s of user %s', current_user.id, note_id, note.user_id)
             return jsonify({'error': 'Not authorized'}), 403
         
         note.public = make_public
         db.session.commit()
         
-        print("✅ Share status updated successfully")
+        logger.debug('Share status of note %s updated', note_id)
         return jsonify({'success': True})
         
-    except Exception as e:
-        print(f"💥 Error in toggle_share: {str(e)}")
+    except Exception:
+        logger.exception('Error in toggle_share')
         return jsonify({'error': 'Server error'}), 500
 
 # ==================== FLAPPY BIRD LEADERBOARD ROUTES ====================
@@ -139,75 +239,48 @@ def submit_flappy_score():
         data = request.get_json()
         score = data.get('score', 0)
         
-        print(f"🎯 SUBMIT SCORE - User: {current_user.first_name}, Score: {score}")
+        logger.debug('Score %s submitted by user %s', score, current_user.id)
         
-        # Always save the score (for statistics)
-        new_score = FlappyScore(
-            score=score,
-            player_name=current_user.first_name,
-            user_id=current_user.id
-        )
-        db.session.add(new_score)
-        db.session.commit()
+        # Always save the score (for statistics); written in batches
+        score_queue.submit(current_user.first_name, score, current_user.id)
         
-        print(f"✅ Score saved: {score}")
+        logger.debug('Score %s queued', score)
         return jsonify({'success': True, 'message': 'Score saved!'})
         
-    except Exception as e:
+    except InvalidScore as e:
+        return jsonify({'success': False, 'error': e.description}), 400
+    except Exception:
         db.session.rollback()
-        print(f"💥 Error submitting score: {str(e)}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        logger.exception('Error submitting score')
+        return jsonify({'success': False, 'error': 'Failed to save score'}), 500
+
+def _leaderboard_payload():
+    # Best-per-player rows and counters are maintained by record_score
+    payload = leaderboard_payload()
+    logger.debug('Leaderboard loaded: %d best scores from %d players',
+                 len(payload['leaderboard']), payload['stats']['total_players'])
+    return {'success': True, **payload}
+
+@views.route('/flappy-leaderboard/stream')
+@login_required
+def leaderboard_stream():
+    # Server-Sent Events: a snapshot, then a diff whenever the top 10 changes
+    version, snapshot = leaderboard_publisher.subscribe()
+    response = Response(leaderboard_publisher.stream(version, snapshot), mimetype='text/event-stream')
+    # Frees the slot whether or not the body was ever iterated
+    response.call_on_close(leaderboard_publisher.unsubscribe)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let a proxy hold events back
+    return response
 
 @views.route('/flappy-leaderboard')
 def get_flappy_leaderboard():
     try:
-        # Get the highest score for each player (only show best)
-        subquery = db.session.query(
-            FlappyScore.player_name,
-            db.func.max(FlappyScore.score).label('max_score')
-        ).group_by(FlappyScore.player_name).subquery()
-        
-        leaderboard = db.session.query(FlappyScore).join(
-            subquery,
-            db.and_(
-                FlappyScore.player_name == subquery.c.player_name,
-                FlappyScore.score == subquery.c.max_score
-            )
-        ).order_by(FlappyScore.score.desc()).limit(10).all()
-        
-        # Rest of the stats calculation remains the same...
-        today = datetime.utcnow().date()
-        start_of_day = datetime(today.year, today.month, today.day)
-        
-        players_today = db.session.query(FlappyScore.player_name).filter(
-            FlappyScore.date_achieved >= start_of_day
-        ).distinct().count()
-        
-        total_games = FlappyScore.query.count()
-        total_players = db.session.query(FlappyScore.player_name).distinct().count()
-        
-        leaderboard_data = []
-        for score in leaderboard:
-            leaderboard_data.append({
-                'player_name': score.player_name,
-                'score': score.score,
-                'date_achieved': score.date_achieved.isoformat()
-            })
-        
-        print(f"📊 Leaderboard loaded - {len(leaderboard_data)} best scores from {total_players} players")
-        
-        return jsonify({
-            'success': True,
-            'leaderboard': leaderboard_data,
-            'stats': {
-                'players_today': players_today,
-                'games_played': total_games,
-                'total_players': total_players
-            }
-        })
+        # Cached between score submissions; pollers get a 304 via ETag
+        return leaderboard_response('views', _leaderboard_payload)
         
     except Exception as e:
-        print(f"💥 Error loading leaderboard: {str(e)}")
+        logger.exception('Error loading leaderboard')
         return jsonify({'success': False, 'error': str(e)}), 500@views.route('/flappy-bird')
 @login_required
 def flappy_bird():